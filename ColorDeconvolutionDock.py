@@ -6,6 +6,8 @@ from sana.color_deconvolution import StainSeparator
 
 from superqt import QRangeSlider
 
+from Deconvolution import DeconvolutionEngine, MIN_OD_VAL, MAX_OD_VAL
+
 class ColorDeconvolutionDockWidget(QDockWidget):
     def __init__(self, name=""):
         super().__init__(name)
@@ -17,13 +19,16 @@ class ColorDeconvolutionDockWidget(QDockWidget):
 class ColorDeconvolutionWidget(QWidget):
     MIN_SLIDER_VAL = 0
     MAX_SLIDER_VAL = 100
-    MIN_OD_VAL = 0.0
-    MAX_OD_VAL = 2.0
+    MIN_OD_VAL = MIN_OD_VAL
+    MAX_OD_VAL = MAX_OD_VAL
 
     def __init__(self):
         super().__init__()
 
         self.ss = StainSeparator('H-DAB')
+
+        # lookup table version of ss, only used if it matches ss within tolerance
+        self.engine = DeconvolutionEngine(self.ss)
         self.stains = ['HEM', 'DAB', 'RES']
 
         self.main_layout = QVBoxLayout()
@@ -0,0 +1,68 @@
+
+import os
+import threading
+
+import numpy as np
+
+# contours of roi outlines, saved next to their mask so they are only traced once
+#  -filename.contours: compressed npz of the vertices of all bodies and holes
+# the cache is keyed by the absolute path, mtime and size of the mask, and is
+# ignored when any of them changed
+
+# a contour read back from the cache, only the polygon is kept
+class CachedContour:
+    def __init__(self, polygon: np.ndarray):
+        self.polygon = polygon
+
+# doesn't end with .npz, so it is never listed as an overlay entry
+def get_cache_filename(filename):
+    return os.path.splitext(filename)[0] + '.contours'
+
+def get_source_key(filename):
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_mtime_ns, stat.st_size
+
+# returns (bodies, holes), or None when there is no valid cache for the mask
+def read_contours(filename):
+    try:
+        source, mtime_ns, size = get_source_key(filename)
+        with np.load(get_cache_filename(filename)) as data:
+            if str(data['source']) != source or int(data['mtime_ns']) != mtime_ns or int(data['size']) != size:
+                return None
+            return split_contours(data['bodies'], data['bodies_lengths']), \
+                   split_contours(data['holes'], data['holes_lengths'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def split_contours(vertices, lengths):
+    if len(lengths) == 0:
+        return []
+    return [CachedContour(polygon) for polygon in np.split(vertices, np.cumsum(lengths)[:-1])]
+
+# writes through a temporary file so a partial cache is never read, nothing is
+# cached when the data directory is read only
+def write_contours(filename, bodies, holes):
+    source, mtime_ns, size = get_source_key(filename)
+    arrays = {
+        'source': np.array(source),
+        'mtime_ns': np.int64(mtime_ns),
+        'size': np.int64(size),
+    }
+    for name, contours in [('bodies', bodies), ('holes', holes)]:
+        polygons = [np.asarray(contour.polygon) for contour in contours]
+        arrays[name+'_lengths'] = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+        if len(polygons) == 0:
+            arrays[name] = np.zeros((0, 2))
+        else:
+            arrays[name] = np.concatenate(polygons)
+
+    # unique per thread, the loader threads can trace the same mask at once
+    cache_filename = get_cache_filename(filename)
+    tmp = '%s.%d.%d.tmp' % (cache_filename, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as fp:
+            np.savez_compressed(fp, **arrays)
+        os.replace(tmp, cache_filename)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
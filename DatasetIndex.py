@@ -0,0 +1,57 @@
+
+import os
+
+# ordered list of every roi in a data directory, scanned once
+#  -data_directory/slide_name/roi_name/slide_name.png
+# the index is reused across navigation and only rescanned when refresh is called
+class DatasetIndex:
+    def __init__(self, data_directory):
+        self.data_directory = data_directory
+        self.refresh()
+
+    def get_directories(self, d):
+        try:
+            with os.scandir(d) as entries:
+                return sorted([entry.name for entry in entries if entry.is_dir()])
+        except FileNotFoundError:
+            return []
+
+    def refresh(self):
+
+        # (slide_name, roi_name, file_name) in navigation order
+        self.entries = []
+        for slide_name in self.get_directories(self.data_directory):
+            slide_directory = os.path.join(self.data_directory, slide_name)
+            for roi_name in self.get_directories(slide_directory):
+                file_name = os.path.join(slide_directory, roi_name, slide_name+'.png')
+                self.entries.append((slide_name, roi_name, file_name))
+
+        # (slide_name, roi_name) -> position in the entries
+        self.positions = {}
+        for i, (slide_name, roi_name, _) in enumerate(self.entries):
+            self.positions[(slide_name, roi_name)] = i
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_position(self, slide_name, roi_name):
+        return self.positions.get((slide_name, roi_name))
+
+    # returns the entry at the position, or None when outside the dataset
+    def get_entry(self, position):
+        if position is None or position < 0 or position >= len(self.entries):
+            return None
+        return self.entries[position]
+
+    # returns the entry n positions after the given roi, or None
+    def get_next(self, slide_name, roi_name, n=1):
+        position = self.get_position(slide_name, roi_name)
+        if position is None:
+            return None
+        return self.get_entry(position + n)
+
+    def get_previous(self, slide_name, roi_name, n=1):
+        position = self.get_position(slide_name, roi_name)
+        if position is None:
+            return None
+        return self.get_entry(position - n)
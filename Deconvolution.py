@@ -0,0 +1,251 @@
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sana.color_deconvolution import StainSeparator
+
+# range of the stain optical densities, the default range of each stain
+MIN_OD_VAL = 0.0
+MAX_OD_VAL = 2.0
+
+# fast path for StainSeparator.separate and combine on uint8 RGB images
+#
+# the separation is a per-channel optical density transform followed by a matrix
+# product, so for uint8 input it is the sum of one 256 entry lookup table per
+# channel. the tables are measured from the separator itself by probing it with
+# every channel value. the recombination is a float32 matrix product followed by
+# a per-channel lookup table of the separator's combine, indexed in fixed point.
+#
+# output matches separate/combine within TOLERANCE grey levels. this is checked
+# against the separator when the engine is built, and valid is False otherwise,
+# in which case the separator itself is used
+#
+# images are processed in stripes of chunk_rows rows on a pool of worker threads,
+# numpy releases the GIL inside the kernels so the stripes run in parallel
+class DeconvolutionEngine:
+
+    # max allowed difference in grey levels from StainSeparator.separate/combine
+    TOLERANCE = 1
+
+    # number of entries in the combine lookup table, sets the fixed point resolution
+    COMBINE_LUT_SIZE = 8192
+
+    # default number of rows per stripe
+    CHUNK_ROWS = 128
+
+    def __init__(self, ss: StainSeparator, num_workers=None, chunk_rows=None):
+        self.ss = ss
+
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if chunk_rows is None:
+            chunk_rows = self.CHUNK_ROWS
+        self.num_workers = num_workers
+        self.chunk_rows = chunk_rows
+        if self.num_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        else:
+            self.executor = None
+
+        self.buffers = {}
+
+        self.build_separate_lut()
+        self.build_combine_lut()
+
+        self.max_error = self.calibrate()
+        self.valid = self.max_error <= self.TOLERANCE
+
+    def build_separate_lut(self):
+        values = np.arange(256, dtype=np.uint8)
+
+        # probe each channel with every value, the others are held at white
+        probes = np.full((3, 256, 3), 255, dtype=np.uint8)
+        for c in range(3):
+            probes[c, :, c] = values
+        base = np.asarray(self.ss.separate(np.full((1, 1, 3), 255, dtype=np.uint8)), dtype=np.float64)[0, 0]
+        response = np.asarray(self.ss.separate(probes), dtype=np.float64)
+
+        # separate(r, g, b) = lut[0][r] + lut[1][g] + lut[2][b], the base is split between channels
+        self.separate_lut = (response - base * 2 / 3).astype(np.float32)
+        self.separate_base = base
+
+        # per-channel density and stain direction, the table is od[v] * direction + constant
+        self.directions = np.zeros((3, 3), dtype=np.float64)
+        self.densities = np.zeros((3, 256), dtype=np.float64)
+        for c in range(3):
+            deltas = response[c] - base
+            direction = deltas[np.argmax(np.linalg.norm(deltas, axis=1))]
+            self.directions[c] = direction
+            self.densities[c] = deltas @ direction / (direction @ direction)
+
+    def build_combine_lut(self):
+
+        # stains -> per-channel density is the inverse of the directions
+        self.stains_to_density = np.linalg.inv(self.directions).astype(np.float32)
+        self.density_offset = (self.separate_base @ np.linalg.inv(self.directions)).astype(np.float32)
+
+        # range of densities the lut covers, densities outside are clamped
+        self.density_min = min(0.0, self.densities.min()) - 1.0
+        self.density_max = self.densities.max() * 2 + 1.0
+        self.density_step = (self.density_max - self.density_min) / (self.COMBINE_LUT_SIZE - 1)
+
+        # probe combine with equal density in every channel at each table entry
+        densities = self.density_min + np.arange(self.COMBINE_LUT_SIZE) * self.density_step
+        stains = densities[:, None] * self.directions.sum(axis=0)[None, :] + self.separate_base
+        response = np.asarray(self.ss.combine(stains[:, None, :]))[:, 0, :]
+
+        # one flat table, channel c starts at c * COMBINE_LUT_SIZE
+        self.combine_lut = np.ascontiguousarray(response.T).reshape(-1)
+        self.combine_lut_offsets = (np.arange(3) * self.COMBINE_LUT_SIZE).astype(np.int32)
+
+    # largest difference from the separator on random pixels and random clipping
+    def calibrate(self):
+        if self.combine_lut.dtype != np.uint8:
+            return np.inf
+
+        rng = np.random.default_rng(0)
+        image_array = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        image_array[0, :, :] = np.arange(64)[:, None] * 4
+
+        reference = np.asarray(self.ss.separate(image_array), dtype=np.float64)
+        stains = self.separate_lut_rows(image_array, np.empty(reference.shape, dtype=np.float32))
+        if not np.allclose(stains, reference, atol=1e-3):
+            return np.inf
+
+        max_error = 0
+        for lo, hi in [(0.0, 2.0), (0.2, 0.8), (0.0, 0.5), (1.0, 2.0)]:
+            clipped = np.clip(reference, lo, hi)
+            expected = np.asarray(self.ss.combine(clipped), dtype=np.int32)
+            result = self.combine_lut_rows(clipped.astype(np.float32), np.empty(expected.shape, dtype=np.uint8))
+            result = result.astype(np.int32)
+            max_error = max(max_error, np.abs(expected - result).max())
+        return max_error
+
+    # reusable scratch buffers of at least size rows, by thread, name and dtype
+    def get_buffer(self, name, size, dtype):
+        key = (threading.get_ident(), name, np.dtype(dtype))
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape[0] < size:
+            buffer = np.empty((size, 3), dtype=dtype)
+            self.buffers[key] = buffer
+        return buffer[:size]
+
+    def clear_buffers(self):
+        self.buffers = {}
+
+    def get_buffers(self):
+        return list(self.buffers.values())
+
+    # calls function(y0, y1) for each stripe of h rows, in parallel when there are workers
+    def map_stripes(self, function, h):
+        stripes = [(y0, min(h, y0 + self.chunk_rows)) for y0 in range(0, h, self.chunk_rows)]
+        if self.executor is None or len(stripes) == 1:
+            for y0, y1 in stripes:
+                function(y0, y1)
+        else:
+            futures = [self.executor.submit(function, y0, y1) for y0, y1 in stripes]
+            for future in futures:
+                future.result()
+
+    # the lookup tables only apply to uint8 RGB
+    def is_lut_input(self, image_array: np.ndarray):
+        return self.valid and image_array.dtype == np.uint8 and \
+            image_array.ndim == 3 and image_array.shape[2] == 3
+
+    # same as StainSeparator.separate, as float32
+    def separate(self, image_array: np.ndarray, out=None):
+        h, w = image_array.shape[:2]
+        if out is None:
+            out = np.empty((h, w, 3), dtype=np.float32)
+
+        if self.is_lut_input(image_array):
+            def separate_stripe(y0, y1):
+                self.separate_lut_rows(image_array[y0:y1], out[y0:y1])
+        else:
+            def separate_stripe(y0, y1):
+                out[y0:y1] = self.ss.separate(image_array[y0:y1])
+        self.map_stripes(separate_stripe, h)
+
+        return out
+
+    # clips the stains to the ranges and recombines them, a range of None disables the stain
+    #  -ranges: [(lo, hi) or None] for each of the 3 stains
+    def deconvolve(self, stains: np.ndarray, ranges, out=None):
+        h, w = stains.shape[:2]
+        if out is None:
+            out = np.empty((h, w, 3), dtype=np.uint8)
+
+        def deconvolve_stripe(y0, y1):
+            clipped = self.get_buffer('clipped', (y1 - y0) * w, np.float32).reshape(y1 - y0, w, 3)
+            self.clip_rows(stains[y0:y1], ranges, clipped)
+            self.combine_rows(clipped, out[y0:y1])
+        self.map_stripes(deconvolve_stripe, h)
+
+        return out
+
+    # separate, clip and combine in one pass over each stripe, so the stains of the whole
+    # image are never held in memory. used when the stains are not reused, e.g. batch renders
+    def deconvolve_image(self, image_array: np.ndarray, ranges, out=None):
+        h, w = image_array.shape[:2]
+        if out is None:
+            out = np.empty((h, w, 3), dtype=np.uint8)
+
+        def deconvolve_stripe(y0, y1):
+            stains = self.get_buffer('clipped', (y1 - y0) * w, np.float32).reshape(y1 - y0, w, 3)
+            if self.is_lut_input(image_array):
+                self.separate_lut_rows(image_array[y0:y1], stains)
+            else:
+                stains[:] = self.ss.separate(image_array[y0:y1])
+            self.clip_rows(stains, ranges, stains)
+            self.combine_rows(stains, out[y0:y1])
+        self.map_stripes(deconvolve_stripe, h)
+
+        return out
+
+    def clip_rows(self, stains: np.ndarray, ranges, out: np.ndarray):
+        for i, stain_range in enumerate(ranges):
+            if stain_range is None:
+                out[:, :, i] = 0
+            else:
+                np.clip(stains[:, :, i], stain_range[0], stain_range[1], out=out[:, :, i])
+
+    def combine_rows(self, stains: np.ndarray, out: np.ndarray):
+        if self.valid:
+            self.combine_lut_rows(stains, out)
+        else:
+            out[:] = self.ss.combine(stains)
+
+    # separate with the lookup tables, out must be a float32 (h, w, 3) array
+    def separate_lut_rows(self, image_array: np.ndarray, out: np.ndarray):
+        pixels = image_array.reshape(-1, 3)
+        stains = out.reshape(-1, 3)
+        scratch = self.get_buffer('separate', stains.shape[0], np.float32)
+
+        np.take(self.separate_lut[0], pixels[:, 0], axis=0, out=stains, mode='clip')
+        np.take(self.separate_lut[1], pixels[:, 1], axis=0, out=scratch, mode='clip')
+        np.add(stains, scratch, out=stains)
+        np.take(self.separate_lut[2], pixels[:, 2], axis=0, out=scratch, mode='clip')
+        np.add(stains, scratch, out=stains)
+
+        return out
+
+    # combine with the lookup table, out must be a uint8 (h, w, 3) array
+    def combine_lut_rows(self, stains: np.ndarray, out: np.ndarray):
+        stains = stains.reshape(-1, 3)
+        density = self.get_buffer('density', stains.shape[0], np.float32)
+        index = self.get_buffer('index', stains.shape[0], np.int32)
+
+        # density = stains @ inverse(directions) - offset, then to a fixed point table index
+        np.matmul(stains, self.stains_to_density, out=density)
+        np.subtract(density, self.density_offset + self.density_min - 0.5 * self.density_step, out=density)
+        np.multiply(density, 1 / self.density_step, out=density)
+        np.clip(density, 0, self.COMBINE_LUT_SIZE - 1, out=density)
+        np.copyto(index, density, casting='unsafe')
+        np.add(index, self.combine_lut_offsets, out=index)
+
+        np.take(self.combine_lut, index, out=out.reshape(-1, 3), mode='clip')
+
+        return out
@@ -0,0 +1,176 @@
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sana.image import Frame
+
+from OverlayDock import get_roi_files, get_mask_files, load_overlay
+from Profiler import profiler
+
+# raised inside a load when it was cancelled before finishing
+class LoadCancelled(Exception):
+    pass
+
+# everything needed to open an roi, so it can be loaded off the gui thread
+#  -image_array: the decoded roi image
+#  -overlays: load_overlay results for the roi outlines, by filename. measurement masks
+#             are large and only loaded when their entry is enabled
+#  -cancel_event: when set, loading stops at the next file
+#  -masks: (measurement, labels) of the enabled mask entries, see FrameCache.set_masks
+class ROIData:
+    def __init__(self, file_name, cancel_event=None, masks=("", frozenset())):
+        self.file_name = file_name
+        self.roi_directory = os.path.dirname(file_name)
+        self.cancel_event = cancel_event
+
+        with profiler.span('decode', file=file_name) as span:
+            self.image_array = Frame(file_name).img
+            span.set(nbytes=self.image_array.nbytes)
+
+        self.overlays = {}
+        for filename, _, _ in get_roi_files(self.roi_directory):
+            self.check_cancelled()
+            self.overlays[filename] = load_overlay(filename, outlines_only=True)
+
+        self.cancel_event = None
+        self.load_masks(masks, cancel_event)
+
+    def get_mask_files(self, masks):
+        return get_mask_files(self.roi_directory, *masks)
+
+    def has_masks(self, masks):
+        return all(filename in self.overlays for filename in self.get_mask_files(masks))
+
+    # loads the masks which are not loaded yet. the overlays are swapped in once all are
+    # loaded, since the gui thread can be reading them when this runs on a loaded roi
+    def load_masks(self, masks, cancel_event=None):
+        overlays = dict(self.overlays)
+        for filename in self.get_mask_files(masks):
+            if not filename in overlays:
+                if not cancel_event is None and cancel_event.is_set():
+                    raise LoadCancelled(self.file_name)
+                overlays[filename] = load_overlay(filename, outlines_only=False)
+        self.overlays = overlays
+
+    def check_cancelled(self):
+        if not self.cancel_event is None and self.cancel_event.is_set():
+            raise LoadCancelled(self.file_name)
+
+    def get_nbytes(self):
+        return self.image_array.nbytes + self.get_overlay_nbytes()
+
+    def get_overlay_nbytes(self):
+        nbytes = 0
+        for mask, bodies, holes in self.overlays.values():
+            if not mask is None:
+                nbytes += mask.get_nbytes()
+            if not bodies is None:
+                nbytes += sum(np.asarray(contour.polygon).nbytes for contour in bodies + holes)
+        return nbytes
+
+    # the image array and the bytes of the overlays, see MemoryBudget
+    def get_buffers(self):
+        return [self.image_array, self.get_overlay_nbytes()]
+
+# LRU cache of loaded rois, bounded by memory. neighbouring rois are loaded
+# ahead of time by a pool of worker threads so that navigating is a cache hit
+class FrameCache:
+    def __init__(self, max_bytes=2 * 1024**3, num_workers=2):
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.lock = threading.Lock()
+
+        # file name -> Future of ROIData
+        self.futures = OrderedDict()
+        self.cancel_events = {}
+
+        # the masks loaded along with each roi
+        self.masks = ("", frozenset())
+
+    # sets the masks to load with the rois, as the measurement and the labels of the
+    # enabled mask entries. rois loaded from now on include them, and rois already
+    # loaded have them added on the next submit
+    def set_masks(self, measurement, labels):
+        self.masks = (measurement, frozenset(labels))
+
+    def submit(self, file_name):
+        with self.lock:
+            future = self.futures.get(file_name)
+            if future is None:
+                self.cancel_events[file_name] = threading.Event()
+                self.futures[file_name] = self.executor.submit(ROIData, file_name, self.cancel_events[file_name], self.masks)
+            elif self.is_loaded(future) and not future.result().has_masks(self.masks):
+                self.cancel_events[file_name] = threading.Event()
+                self.futures[file_name] = self.executor.submit(self.add_masks, future.result(), self.cancel_events[file_name], self.masks)
+            self.futures.move_to_end(file_name)
+            return self.futures[file_name]
+
+    def add_masks(self, roi_data, cancel_event, masks):
+        roi_data.load_masks(masks, cancel_event)
+        return roi_data
+
+    # stops a load that has not finished yet, it is dropped from the cache
+    def cancel(self, file_name):
+        with self.lock:
+            future = self.futures.get(file_name)
+            if future is None or self.is_loaded(future):
+                return
+            future.cancel()
+            self.cancel_events.pop(file_name).set()
+            del self.futures[file_name]
+
+    # drops a failed load, so the file is read again next time in case it was fixed
+    def discard(self, file_name, future):
+        with self.lock:
+            if self.futures.get(file_name) is future:
+                del self.futures[file_name]
+                del self.cancel_events[file_name]
+
+    # starts loading the given rois in the background
+    def prefetch(self, file_names, keep=()):
+        for file_name in file_names:
+            if os.path.exists(file_name):
+                self.submit(file_name)
+        self.trim(keep=list(keep) + list(file_names))
+
+    def get_buffers(self):
+        with self.lock:
+            futures = [future for future in self.futures.values() if self.is_loaded(future)]
+        return [buffer for future in futures for buffer in future.result().get_buffers()]
+
+    # only rois which finished loading are counted, must be called with the lock held
+    def count_nbytes(self):
+        return sum(future.result().get_nbytes() for future in self.futures.values() if self.is_loaded(future))
+
+    def is_loaded(self, future):
+        return future.done() and not future.cancelled() and future.exception() is None
+
+    # evicts the least recently used loaded rois until under budget
+    def trim(self, keep=(), max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self.lock:
+            for file_name in list(self.futures.keys()):
+                if self.count_nbytes() <= max_bytes:
+                    break
+                if file_name in keep or not self.is_loaded(self.futures[file_name]):
+                    continue
+                del self.futures[file_name]
+                del self.cancel_events[file_name]
+
+    # evicts the least recently used loaded rois until nbytes are freed
+    def evict(self, nbytes, keep=()):
+        with self.lock:
+            max_bytes = self.count_nbytes() - nbytes
+        self.trim(keep, max_bytes)
+
+    def clear(self):
+        with self.lock:
+            for file_name, future in self.futures.items():
+                future.cancel()
+                self.cancel_events[file_name].set()
+            self.futures.clear()
+            self.cancel_events.clear()
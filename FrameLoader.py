@@ -0,0 +1,61 @@
+
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
+
+from FrameCache import FrameCache, LoadCancelled
+
+# loads rois through the frame cache without blocking the gui thread. only the
+# latest request is delivered, a newer request cancels the one before it
+class FrameLoader(QObject):
+    loaded = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+    # emitted from the worker thread, delivered on the gui thread
+    job_finished = pyqtSignal(str, object)
+
+    def __init__(self, frame_cache: FrameCache):
+        super().__init__()
+
+        self.frame_cache = frame_cache
+
+        # the latest request, a job is stale unless its future is this one. a file can be
+        # requested again before its cancelled job is delivered, so names can't tell them apart
+        self.file_name = None
+        self.future = None
+
+        self.job_finished.connect(self.finish_job, Qt.ConnectionType.QueuedConnection)
+
+    def is_loading(self):
+        return not self.future is None
+
+    def load(self, file_name):
+        if self.file_name == file_name:
+            return
+
+        # the previous request is stale, stop it if it is still queued or running
+        if not self.file_name is None:
+            self.frame_cache.cancel(self.file_name)
+
+        self.file_name = file_name
+        self.future = self.frame_cache.submit(file_name)
+        self.future.add_done_callback(lambda future: self.job_finished.emit(file_name, future))
+
+    def finish_job(self, file_name, future):
+
+        # a newer request replaced this one
+        if not future is self.future:
+            return
+        self.file_name = None
+        self.future = None
+
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if isinstance(exception, LoadCancelled):
+            return
+        if not exception is None:
+            self.frame_cache.discard(file_name, future)
+            self.failed.emit(file_name, str(exception))
+            return
+
+        self.frame_cache.trim(keep=[file_name])
+        self.loaded.emit(file_name, future.result())
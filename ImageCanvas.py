@@ -0,0 +1,256 @@
+
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QRect, QRectF
+from PyQt5.QtGui import QImage, QPixmap, QPalette, QPainter, QPen, QTransform
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsItem, QStyleOptionGraphicsItem
+
+from Rendering import render_region, DisplayTransform
+from ImagePyramid import ImagePyramid
+from Profiler import profiler
+
+# LRU cache of rendered tiles, keyed by (image key, transform key, tile x, tile y)
+class TileCache:
+    def __init__(self, max_tiles=256):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def get(self, key):
+        pixmap = self.tiles.get(key)
+        if not pixmap is None:
+            self.tiles.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        self.tiles[key] = pixmap
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+    # removes the tiles of the given image and transform that satisfy the condition
+    def remove(self, image_key, transform_key, condition):
+        for key in list(self.tiles.keys()):
+            if key[0] == image_key and key[1] == transform_key and condition(key[2], key[3]):
+                del self.tiles[key]
+
+    def clear(self):
+        self.tiles.clear()
+
+    def get_nbytes(self):
+        return sum(get_pixmap_nbytes(pixmap) for pixmap in self.tiles.values())
+
+    # evicts the least recently used tiles until nbytes are freed, they are rendered again when visible
+    def evict(self, nbytes):
+        while nbytes > 0 and len(self.tiles) != 0:
+            _, pixmap = self.tiles.popitem(last=False)
+            nbytes -= get_pixmap_nbytes(pixmap)
+
+def get_pixmap_nbytes(pixmap: QPixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+# renders fixed size tiles of an image pyramid, rotated and rescaled by a display transform
+class TileProvider:
+    TILE_SIZE = 256
+
+    def __init__(self):
+        self.pyramid = None
+        self.transform = None
+
+    def set_image(self, pyramid: ImagePyramid, transform: DisplayTransform):
+        self.pyramid = pyramid
+        self.transform = transform
+
+    # size of the full displayed image, this is never allocated
+    def get_size(self):
+        return self.transform.get_size()
+
+    def get_tile_rect(self, tx, ty):
+        w, h = self.get_size()
+        rect = QRect(tx * self.TILE_SIZE, ty * self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE)
+        return rect.intersected(QRect(0, 0, w, h))
+
+    # tile indices which intersect the given rect of the displayed image
+    def get_tiles(self, rect: QRect):
+        tx0 = max(0, rect.left() // self.TILE_SIZE)
+        ty0 = max(0, rect.top() // self.TILE_SIZE)
+        tx1 = rect.right() // self.TILE_SIZE
+        ty1 = rect.bottom() // self.TILE_SIZE
+        return [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+
+    # renders the given rect of the displayed image from the nearest pyramid level
+    def render_region(self, rect: QRect):
+        level_array, level_scale = self.pyramid.get_level_for_scale(self.transform.scale_factor)
+        with profiler.span('warp', nbytes=rect.width() * rect.height() * 3):
+            image_array = render_region(
+                level_array, level_scale, self.transform,
+                rect.x(), rect.y(), rect.width(), rect.height(),
+            )
+        image = QImage(
+            image_array,
+            image_array.shape[1],
+            image_array.shape[0],
+            image_array.strides[0],
+            QImage.Format.Format_RGB888,
+        )
+        return image_array, image
+
+    def render_tile(self, tx, ty):
+        _, image = self.render_region(self.get_tile_rect(tx, ty))
+        with profiler.span('upload', nbytes=image.sizeInBytes()):
+            return QPixmap.fromImage(image)
+
+# scene item the size of the displayed image, only the exposed tiles are drawn
+class TiledImageItem(QGraphicsItem):
+    def __init__(self, provider: TileProvider, cache: TileCache):
+        super().__init__()
+
+        self.provider = provider
+        self.cache = cache
+        self.image_key = 0
+
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption, True)
+
+    def boundingRect(self):
+        if self.provider.pyramid is None:
+            return QRectF()
+        w, h = self.provider.get_size()
+        return QRectF(0, 0, w, h)
+
+    def paint(self, painter, option: QStyleOptionGraphicsItem, widget=None):
+        if self.provider.pyramid is None:
+            return
+
+        exposed_rect = option.exposedRect.toAlignedRect().intersected(self.boundingRect().toAlignedRect())
+        for tx, ty in self.provider.get_tiles(exposed_rect):
+            key = (self.image_key, self.provider.transform.get_key(), tx, ty)
+            pixmap = self.cache.get(key)
+            if pixmap is None:
+                pixmap = self.provider.render_tile(tx, ty)
+                self.cache.put(key, pixmap)
+            painter.drawPixmap(self.provider.get_tile_rect(tx, ty).topLeft(), pixmap)
+
+# maps source pixel coords to the display, offset so that (x, y) is the origin.
+# pixel centers are at +0.5 in painter coords
+def get_outline_transform(transform: DisplayTransform, x=0, y=0):
+    M = transform.matrix
+    return QTransform(M[0, 0], M[1, 0], M[0, 1], M[1, 1], M[0, 2] + 0.5 - x, M[1, 2] + 0.5 - y)
+
+# draws outlines as (QPainterPath, QColor, linewidth in source pixels), also used by
+# batch_render so that rendered rois look like the viewer
+def draw_outlines(painter: QPainter, transform: DisplayTransform, outlines, x=0, y=0):
+    painter.save()
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setTransform(get_outline_transform(transform, x, y), True)
+    painter.setBrush(Qt.BrushStyle.NoBrush)
+    for path, color, linewidth in outlines:
+        pen = QPen(color, linewidth)
+        pen.setCapStyle(Qt.PenCapStyle.RoundCap)
+        pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
+        painter.setPen(pen)
+        painter.drawPath(path)
+    painter.restore()
+
+# scene item drawn over the image, the outlines are paths in source image coords
+# which are transformed when painted, so they stay sharp at any zoom and changing
+# them only repaints the vectors, never the tiles
+class OutlineItem(QGraphicsItem):
+    def __init__(self, provider: TileProvider):
+        super().__init__()
+
+        self.provider = provider
+
+        # (QPainterPath, QColor, linewidth in source pixels)
+        self.outlines = []
+
+    def boundingRect(self):
+        if self.provider.pyramid is None:
+            return QRectF()
+        w, h = self.provider.get_size()
+        return QRectF(0, 0, w, h)
+
+    def draw(self, painter: QPainter, x=0, y=0):
+        draw_outlines(painter, self.provider.transform, self.outlines, x, y)
+
+    def paint(self, painter, option: QStyleOptionGraphicsItem, widget=None):
+        if self.provider.pyramid is None or len(self.outlines) == 0:
+            return
+        self.draw(painter)
+
+# displays an image pyramid as a grid of tiles, only rendering the tiles that
+# are visible and have not been rendered before at the current rotation and scale
+class ImageCanvas(QGraphicsView):
+    def __init__(self):
+        super().__init__()
+
+        self.setBackgroundRole(QPalette.ColorRole.Base)
+        self.setAlignment(Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignHCenter)
+
+        self.provider = TileProvider()
+        self.cache = TileCache()
+
+        self.item = TiledImageItem(self.provider, self.cache)
+        self.outline_item = OutlineItem(self.provider)
+        self.graphics_scene = QGraphicsScene()
+        self.graphics_scene.addItem(self.item)
+        self.graphics_scene.addItem(self.outline_item)
+        self.setScene(self.graphics_scene)
+
+    # sets the image to display, when dirty_rect is given and the image is the same size
+    # as before, only tiles intersecting it are re-rendered. dirty_rect is in image coords
+    def set_image(self, pyramid: ImagePyramid, transform: DisplayTransform, dirty_rect: QRect = None):
+        previous_pyramid = self.provider.pyramid
+
+        self.item.prepareGeometryChange()
+        self.outline_item.prepareGeometryChange()
+        self.provider.set_image(pyramid, transform)
+
+        if previous_pyramid is None or dirty_rect is None or \
+           previous_pyramid.get_shape() != pyramid.get_shape():
+            self.item.image_key += 1
+            self.cache.clear()
+        else:
+            self.invalidate_image_rect(dirty_rect)
+
+        w, h = self.provider.get_size()
+        self.setSceneRect(QRectF(0, 0, w, h))
+        self.item.update()
+        self.outline_item.update()
+
+    # outlines drawn over the image, as (QPainterPath, QColor, linewidth), see OutlineItem
+    def set_outlines(self, outlines):
+        self.outline_item.outlines = outlines
+        self.outline_item.update()
+
+    # removes the tiles of all cached transforms which intersect the rect, given in image coords
+    def invalidate_image_rect(self, rect: QRect):
+        tile_size = self.provider.TILE_SIZE
+        shape = self.provider.pyramid.get_shape()
+        def intersects(transform_key):
+            transform = DisplayTransform(shape, *transform_key)
+
+            # pad by the support of the cubic kernel and the area averaged pyramid levels
+            margin = math.ceil(4 * max(1, transform.scale_factor))
+            mapped_rect = QRect(*transform.map_rect(rect.x(), rect.y(), rect.width(), rect.height()))
+            mapped_rect = mapped_rect.adjusted(-margin, -margin, margin, margin)
+            return lambda tx, ty: mapped_rect.intersects(QRect(tx * tile_size, ty * tile_size, tile_size, tile_size))
+        for transform_key in set(key[1] for key in self.cache.tiles.keys()):
+            self.cache.remove(self.item.image_key, transform_key, intersects(transform_key))
+
+    # size of the displayed image, in screen pixels
+    def get_image_width(self):
+        return self.provider.get_size()[0] if not self.provider.pyramid is None else 0
+    def get_image_height(self):
+        return self.provider.get_size()[1] if not self.provider.pyramid is None else 0
+
+    # renders the given rect of the displayed image with its outlines, in image pixels
+    def render_region(self, rect: QRect):
+        w, h = self.provider.get_size()
+        rect = rect.intersected(QRect(0, 0, w, h))
+        image_array, image = self.provider.render_region(rect)
+        if len(self.outline_item.outlines) != 0:
+            with profiler.span('outlines'):
+                painter = QPainter(image)
+                self.outline_item.draw(painter, rect.x(), rect.y())
+                painter.end()
+        return image_array, image
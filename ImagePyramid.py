@@ -0,0 +1,131 @@
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from Profiler import profiler
+
+# power of two image pyramid, levels are built with area averaging on first use
+#  -level 0 is the given image, level k is downsampled by 2^k
+#  -scale: scale of the given image relative to the full resolution image, used
+#          when level 0 is itself a downsampled preview. either a float or (scale_x, scale_y)
+# odd sides are rounded up when halved, so the levels are scaled slightly differently
+# along each axis and their scales are kept per axis
+class ImagePyramid:
+
+    # smallest level side, no levels are built below this
+    MIN_SIZE = 64
+
+    def __init__(self, image_array: np.ndarray, scale=1.0):
+        self.levels = [image_array]
+        if np.isscalar(scale):
+            scale = (scale, scale)
+        self.scale_x, self.scale_y = scale
+
+    # shape of the full resolution image
+    def get_shape(self):
+        h, w = self.levels[0].shape[:2]
+        if self.scale_x == 1.0 and self.scale_y == 1.0:
+            return self.levels[0].shape
+        return (int(round(h / self.scale_y)), int(round(w / self.scale_x))) + self.levels[0].shape[2:]
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            previous = self.levels[-1]
+            w = max(1, (previous.shape[1] + 1) // 2)
+            h = max(1, (previous.shape[0] + 1) // 2)
+            with profiler.span('downsample') as span:
+                self.levels.append(cv2.resize(previous, dsize=(w, h), interpolation=cv2.INTER_AREA))
+                span.set(nbytes=self.levels[-1].nbytes)
+        return self.levels[level]
+
+    # (scale_x, scale_y) of the given level relative to the full resolution image
+    def get_level_scale(self, level):
+        h, w = self.get_level(level).shape[:2]
+        return (self.scale_x * w / self.levels[0].shape[1], self.scale_y * h / self.levels[0].shape[0])
+
+    # finds the smallest level which is at or above the target scale
+    def get_level_for_scale(self, scale_factor: float):
+        level = 0
+        h, w = self.levels[0].shape[:2]
+        while scale_factor <= self.scale_x * 0.5 ** (level + 1) and min(h, w) / 2 ** (level + 1) >= self.MIN_SIZE:
+            level += 1
+        return self.get_level(level), self.get_level_scale(level)
+
+    def get_nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    # bytes of the downsampled levels, level 0 is the image the pyramid was built on
+    # and is owned by whatever passed it in
+    def get_level_nbytes(self):
+        return sum(level.nbytes for level in self.levels[1:])
+
+    # drops the downsampled levels, they are rebuilt when next used
+    def clear_levels(self):
+        del self.levels[1:]
+
+    # updates the built levels after the rect (x, y, w, h) of level 0 was modified in place
+    def update_region(self, x, y, w, h):
+        x0, y0, x1, y1 = x, y, x + w, y + h
+        for level in range(1, len(self.levels)):
+            previous = self.levels[level - 1]
+
+            # an even sized level is halved in exact 2x2 blocks, so the rect can be resampled
+            # on its own. otherwise this level and the ones above are rebuilt when next used
+            if previous.shape[0] % 2 != 0 or previous.shape[1] % 2 != 0:
+                del self.levels[level:]
+                break
+            x0, y0 = x0 // 2, y0 // 2
+            x1, y1 = (x1 + 1) // 2, (y1 + 1) // 2
+            block = previous[2 * y0:2 * y1, 2 * x0:2 * x1]
+            self.levels[level][y0:y1, x0:x1] = cv2.resize(block, dsize=(x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+
+# LRU cache of pyramids, bounded by the total bytes of their levels
+class PyramidCache:
+    def __init__(self, max_bytes=512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.pyramids = OrderedDict()
+
+    def get(self, key, image_array: np.ndarray, scale=1.0):
+        if key in self.pyramids:
+            self.pyramids.move_to_end(key)
+        else:
+            self.pyramids[key] = ImagePyramid(image_array, scale)
+        self.trim()
+        return self.pyramids[key]
+
+    # moves a pyramid whose image was modified in place to a new key, only updating the
+    # levels within the rect. rect is (x, y, w, h) in the image's coords
+    def update(self, key, new_key, image_array: np.ndarray, rect, scale=1.0):
+        pyramid = self.pyramids.pop(key, None)
+        if pyramid is None or not pyramid.levels[0] is image_array:
+            return self.get(new_key, image_array, scale)
+        pyramid.update_region(*rect)
+        self.pyramids[new_key] = pyramid
+        return pyramid
+
+    def get_nbytes(self):
+        return sum(pyramid.get_nbytes() for pyramid in self.pyramids.values())
+
+    def get_buffers(self):
+        return [level for pyramid in self.pyramids.values() for level in pyramid.levels]
+
+    # evicts the least recently used pyramids until nbytes are freed, then the
+    # downsampled levels of the newest one. only the downsampled levels count as
+    # freed, the frame cache or the render stages still hold level 0
+    def evict(self, nbytes):
+        while nbytes > 0 and len(self.pyramids) > 1:
+            _, pyramid = self.pyramids.popitem(last=False)
+            nbytes -= pyramid.get_level_nbytes()
+        if nbytes > 0:
+            for pyramid in self.pyramids.values():
+                pyramid.clear_levels()
+
+    # evicts the least recently used pyramids until under budget, never the newest
+    def trim(self):
+        while len(self.pyramids) > 1 and self.get_nbytes() > self.max_bytes:
+            self.pyramids.popitem(last=False)
+
+    def clear(self):
+        self.pyramids.clear()
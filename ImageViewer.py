@@ -2,27 +2,53 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sys
 import math
 import time
 
 import cv2
 import numpy as np
-from sana.image import Frame, overlay_mask
-from PIL import Image
-from PIL.ImageQt import ImageQt
-import pandas as pd
 
-from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF
-from PyQt5.QtGui import QImage, QPixmap, QPalette, QPainter, QGuiApplication, QTransform, QMouseEvent
-from PyQt5.QtWidgets import QLabel, QSizePolicy, QScrollArea, QMessageBox, QMainWindow, QMenu, QFileDialog, QStyle, QToolBar, QPushButton, QDockWidget, QDial, QLineEdit, QWidget, QVBoxLayout, QSpinBox, QApplication, QAction
+from PyQt5.QtCore import Qt, QPoint, QRect, QTimer
+from PyQt5.QtGui import QMouseEvent, QColor
+from PyQt5.QtWidgets import QLabel, QMessageBox, QMainWindow, QMenu, QFileDialog, QStyle, QToolBar, QPushButton, QDockWidget, QDial, QApplication, QAction, QInputDialog, QProgressBar
 
 from ColorDeconvolutionDock import ColorDeconvolutionDockWidget
 from OverlayDock import OverlayDockWidget
 from LabeledSpinBox import LabeledSpinBoxWidget
+from RenderPipeline import RenderStage
+from ImageCanvas import ImageCanvas
+from ImagePyramid import PyramidCache
+from OverlayCompositor import OverlayCompositor, OverlayLayer
+from Rendering import DisplayTransform
+from FrameCache import FrameCache
+from DatasetIndex import DatasetIndex
+from FrameLoader import FrameLoader
+from RenderScheduler import RenderScheduler
+from ScoreStore import ScoreStore
+from ScoreJournal import ScoreJournal, read_spreadsheet, write_spreadsheet
+from Profiler import profiler, summarize_spans, format_nbytes
+from MemoryBudget import MemoryBudget
 
 class ImageViewer(QMainWindow):
-    def __init__(self, init_f=None):
+
+    # number of rois after the current one which are loaded in the background
+    PREFETCH_AHEAD = 2
+
+    # largest side of the downsampled source used while a stain slider is moving
+    PREVIEW_SIZE = 1024
+
+    # ms without slider movement before the full resolution image replaces the preview
+    PREVIEW_IDLE = 300
+
+    # ms between background rewrites of the spreadsheet from the score journal
+    COMPACT_INTERVAL = 60000
+
+    # ms between refreshes of the timings readout
+    TIMINGS_INTERVAL = 500
+
+    # memory_budget: bytes of image buffers and caches to stay under, by default half
+    # of the physical memory, see MemoryBudget
+    def __init__(self, init_f=None, memory_budget=None):
         super().__init__()
 
         # TODO: this might be off by a pixel?
@@ -37,20 +63,22 @@ class ImageViewer(QMainWindow):
 
         self.scale_factor = 1.0
         self.rotation_angle = 0
-        self.df = None
+        self.scores = None
+        self.score_journal = None
+
+        # downsampled levels of the displayed image, so zooming out is cheap
+        self.pyramid_cache = PyramidCache()
 
-        self.image_label = QLabel()
-        self.image_label.setBackgroundRole(QPalette.ColorRole.Base)
-        self.image_label.setSizePolicy(QSizePolicy.Policy.Ignored, QSizePolicy.Policy.Ignored)
-        self.image_label.setScaledContents(True)
+        # loaded rois, the neighbours of the current roi are loaded in the background
+        self.frame_cache = FrameCache()
+        self.dataset_index = None
+        self.create_frame_loader()
 
-        self.scroll_area = QScrollArea()
-        # self.scroll_area.setBackgroundRole(QPalette.Dark)
-        self.scroll_area.setWidget(self.image_label)
-        self.scroll_area.setVisible(False)
-        self.scroll_area.setAlignment(Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignHCenter)
+        # the image is displayed as tiles, only visible tiles are rendered, see ImageCanvas
+        self.canvas = ImageCanvas()
+        self.canvas.setVisible(False)
 
-        self.setCentralWidget(self.scroll_area)
+        self.setCentralWidget(self.canvas)
 
         # toolbars
         self.create_navigation_toolbar()
@@ -61,6 +89,21 @@ class ImageViewer(QMainWindow):
         self.create_deconvolution_dock()
         self.create_overlay_dock()
 
+        # render chain
+        self.create_render_pipeline()
+
+        # every image buffer and cache counts against one budget
+        self.create_memory_budget(memory_budget)
+
+        # score changes are journaled as they happen, and compacted into the spreadsheet
+        self.compact_timer = QTimer()
+        self.compact_timer.setInterval(self.COMPACT_INTERVAL)
+        self.compact_timer.timeout.connect(self.compact_score_journal)
+        self.compact_timer.start()
+
+        # per stage timings since the last render, only recorded while they are shown
+        self.create_timings_label()
+
         # actions
         self.create_actions()
 
@@ -79,15 +122,22 @@ class ImageViewer(QMainWindow):
         self.resize(size)
 
     def quit(self):
+        self.close()
 
-        if not self.df is None:
-            reply = QMessageBox.question(self, "Image Viewer", "Save ordinal scores before quit?", QMessageBox.Yes|QMessageBox.No)
+    # also reached by closing the window. unsaved scores are kept in the autosave
+    # and restored by the next import, the imported spreadsheet is left as it is
+    def closeEvent(self, event):
+        if not self.score_journal is None and self.score_journal.has_unsaved():
+            message = "Ordinal scores are autosaved to %s. Save ordinal scores before quit?" % self.score_journal.autosave_name
+            reply = QMessageBox.question(self, "Image Viewer", message, QMessageBox.Yes|QMessageBox.No)
             if reply == QMessageBox.Yes:
                 success = self.save_spreadsheet()
                 if not success:
+                    event.ignore()
                     return
 
-        self.close()
+        self.close_score_journal()
+        super().closeEvent(event)
 
     def open_frame(self, file_name=""):
         if file_name == "" or file_name == False:
@@ -98,131 +148,147 @@ class ImageViewer(QMainWindow):
             if not os.path.exists(file_name):
                 QMessageBox.information(self, "Image Viewer", "File does not exist: %s" % file_name)
                 return
-            try:
-                frame = Frame(file_name)
-                image_array = frame.img
-                # image_array = np.asarray(Image.open(file_name))
-            except:
-                QMessageBox.information(self, "Image Viewer", "Cannot load %s" % file_name)
-                return
 
-        # parse the data storage structure
+            # navigation continues from the requested roi, even before it has loaded
+            data_directory, self.requested_slide_name, self.requested_roi_name = self.parse_file_name(file_name)
+            self.update_dataset_index(data_directory, self.requested_slide_name, self.requested_roi_name)
+
+            # the frame is loaded in the background, see frame_loaded
+            self.statusBar().showMessage("Loading %s %s..." % (self.requested_slide_name, self.requested_roi_name))
+            self.loading_bar.show()
+            self.frame_loader.load(file_name)
+
+    # parses the data storage structure, data_directory/slide_name/roi_name/slide_name.png
+    def parse_file_name(self, file_name):
+        roi_directory, _ = os.path.split(file_name)
+        slide_directory, roi_name = os.path.split(roi_directory)
+        data_directory, slide_name = os.path.split(slide_directory)
+        return data_directory, slide_name, roi_name
+
+    def create_frame_loader(self):
+        self.frame_loader = FrameLoader(self.frame_cache)
+        self.frame_loader.loaded.connect(self.frame_loaded)
+        self.frame_loader.failed.connect(self.frame_load_failed)
+
+        self.loading_bar = QProgressBar()
+        self.loading_bar.setRange(0, 0)
+        self.loading_bar.setMaximumWidth(150)
+        self.loading_bar.hide()
+        self.statusBar().addPermanentWidget(self.loading_bar)
+
+        self.requested_slide_name = ""
+        self.requested_roi_name = ""
+        self.file_name = ""
+
+    def frame_loaded(self, file_name, roi_data):
+        self.loading_bar.hide()
+        self.statusBar().clearMessage()
+
+        self.roi_data = roi_data
+
         self.file_name = file_name
         self.roi_directory, _ = os.path.split(self.file_name)
         self.slide_directory, self.roi_name = os.path.split(self.roi_directory)
         self.data_directory, self.slide_name = os.path.split(self.slide_directory)
 
         # update the necessary widgets
-        self.set_source_image(image_array)
-
-    def get_directories(self, d):
-        return sorted([x for x in os.listdir(d) if os.path.isdir(os.path.join(d, x))])
-
-    def get_next_frame(self):
-
-        # find the next roi in the slide directory
-        roi_names = self.get_directories(self.slide_directory)
-        next_roi_name_idx = roi_names.index(self.roi_name) + 1
-        if next_roi_name_idx < len(roi_names):
-            next_slide_name = self.slide_name
-            next_roi_name = roi_names[next_roi_name_idx]
-        
-        # find the first roi in the next slide
-        else:
-            slide_names = self.get_directories(self.data_directory)
-
-            # look forward through the slides
-            i = 1
-            while True:
-
-                # get the next slide
-                next_slide_name_idx = slide_names.index(self.slide_name) + i
-                if next_slide_name_idx < len(slide_names):
-                    next_slide_name = slide_names[next_slide_name_idx]
-                    next_slide_directory = os.path.join(self.data_directory, next_slide_name)
-
-                    # get the first roi in this new slide
-                    roi_names = self.get_directories(next_slide_directory)
-                    if len(roi_names) != 0:
-                        next_roi_name = roi_names[0]
-                        break
-
-                    # slide is empty, continue to next slide
-                    else:
-                        i += 1
-
-                # no more slides and rois to look for
-                else:
-                    next_slide_name = ""
-                    next_roi_name = ""
-                    break
+        self.set_source_image(self.roi_data.image_array)
+
+        # start loading the neighbouring rois
+        self.prefetch_frames()
+
+    def frame_load_failed(self, file_name, message):
+        self.loading_bar.hide()
+        self.statusBar().clearMessage()
+
+        # go back to navigating from the displayed roi
+        if self.source_stage.result is not None:
+            self.requested_slide_name, self.requested_roi_name = self.slide_name, self.roi_name
+
+        QMessageBox.information(self, "Image Viewer", "Cannot load %s" % file_name)
+
+    # loads the next PREFETCH_AHEAD rois and the previous roi, fewer when they wouldn't
+    # fit in the memory budget next to the current one. the caches the budget can evict
+    # make room for them, so only what it can't evict is counted. the rois are in order
+    # of how likely they are to be opened next, so going back is kept over looking ahead
+    def prefetch_frames(self):
+        entries = [self.dataset_index.get_next(self.slide_name, self.roi_name, 1),
+                   self.dataset_index.get_previous(self.slide_name, self.roi_name)]
+        for n in range(2, self.PREFETCH_AHEAD+1):
+            entries.append(self.dataset_index.get_next(self.slide_name, self.roi_name, n))
+        file_names = [entry[2] for entry in entries if not entry is None]
+        n = max(0, self.memory_budget.max_bytes - self.get_reserved_nbytes()) // max(1, self.roi_data.get_nbytes())
+        self.frame_cache.prefetch(file_names[:n], keep=[self.file_name])
+
+    # bytes the budget can't evict: the displayed buffers, which include the roi image,
+    # the overlay entries and the overlays of the roi. enabled masks are in both of the
+    # last two, erring on the safe side
+    def get_reserved_nbytes(self):
+        usage = self.memory_budget.get_usage()
+        return usage['displayed'] + usage['overlays'] + self.roi_data.get_overlay_nbytes()
+
+    # scans the data directory once, rescanned only on refresh or when the roi is missing
+    def update_dataset_index(self, data_directory, slide_name, roi_name):
+        if self.dataset_index is None or self.dataset_index.data_directory != data_directory:
+            self.dataset_index = DatasetIndex(data_directory)
+        elif self.dataset_index.get_position(slide_name, roi_name) is None:
+            self.dataset_index.refresh()
+
+    def refresh_dataset_index(self):
+        if self.dataset_index is None or self.source_stage.result is None:
+            return
+        self.dataset_index.refresh()
+        self.update_navigation_toolbar()
+        self.prefetch_frames()
 
+    def get_next_frame(self, n=1):
+        entry = self.dataset_index.get_next(self.slide_name, self.roi_name, n)
+        if entry is None:
+            return "", ""
+        next_slide_name, next_roi_name, _ = entry
         return next_slide_name, next_roi_name
-                
-    def get_previous_frame(self):
-
-        # find the previous roi in the slide directory
-        roi_names = self.get_directories(self.slide_directory)
-        previous_roi_name_idx = roi_names.index(self.roi_name) - 1
-        if previous_roi_name_idx >= 0:
-            previous_slide_name = self.slide_name
-            previous_roi_name = roi_names[previous_roi_name_idx]
-    
-        # find the last roi in the previous slide
-        else:
-            slide_names = self.get_directories(self.data_directory)
-
-            # look backward through the slides
-            i = 1
-            while True:
-
-                # get the previous slide
-                previous_slide_name_idx = slide_names.index(self.slide_name) - i
-                if previous_slide_name_idx >= 0:
-                    previous_slide_name = slide_names[previous_slide_name_idx]
-                    previous_slide_directory = os.path.join(self.data_directory, previous_slide_name)
-
-                    # get the last roi in this new slide
-                    roi_names = self.get_directories(previous_slide_directory)
-                    if len(roi_names) != 0:
-                        previous_roi_name = roi_names[-1]
-                        break
-
-                    # slide is empty, continue to previous slide
-                    else:
-                        i -= 1
-
-                # no more slides and rois to look for
-                else:
-                    previous_slide_name = ""
-                    previous_roi_name = ""
-                    break
 
+    def get_previous_frame(self, n=1):
+        entry = self.dataset_index.get_previous(self.slide_name, self.roi_name, n)
+        if entry is None:
+            return "", ""
+        previous_slide_name, previous_roi_name, _ = entry
         return previous_slide_name, previous_roi_name
 
-    def open_previous_frame(self):
-        if self.previous_roi_name != "":
-            file_name = os.path.join(self.data_directory, self.previous_slide_name, self.previous_roi_name, self.previous_slide_name+'.png')
+    # opens the roi at a 1-based position in the dataset
+    def go_to_frame(self):
+        if self.dataset_index is None or len(self.dataset_index) == 0:
+            return
+        position = self.dataset_index.get_position(self.requested_slide_name, self.requested_roi_name)
+        position = 0 if position is None else position
+        value, ok = QInputDialog.getInt(self, "Image Viewer", "Go to ROI (1-%d):" % len(self.dataset_index),
+                                        position + 1, 1, len(self.dataset_index))
+        if ok:
+            _, _, file_name = self.dataset_index.get_entry(value - 1)
             self.open_frame(file_name)
 
+    # steps from the last requested roi, so rapid presses skip ahead instead of queueing loads
+    def open_previous_frame(self):
+        entry = self.dataset_index.get_previous(self.requested_slide_name, self.requested_roi_name)
+        if not entry is None:
+            self.open_frame(entry[2])
+
     def open_next_frame(self):
-        if self.next_roi_name != "":
-            file_name = os.path.join(self.data_directory, self.next_slide_name, self.next_roi_name, self.next_slide_name+'.png')
-            self.open_frame(file_name)      
+        entry = self.dataset_index.get_next(self.requested_slide_name, self.requested_roi_name)
+        if not entry is None:
+            self.open_frame(entry[2])
                  
     def set_source_image(self, image_array: np.ndarray):
         self.source_image_array = image_array
+        self.source_stage.set_result(self.source_image_array)
 
-        self.source_image = QImage(
-            self.source_image_array, 
-            self.source_image_array.shape[1], 
-            self.source_image_array.shape[0],
-            self.source_image_array.strides[0],
-            QImage.Format.Format_RGB888
-        )
+        # free the previous frame's separation and buffers, they are rebuilt when needed
+        self.separated_stage.clear()
+        self.preview_separated_stage.clear()
+        self.deconvolution_dock.widget.engine.clear_buffers()
 
         # calculate aspect ratio of the source image
-        self.aspect_ratio = self.source_image.height() / self.source_image.width()
+        self.aspect_ratio = self.source_image_array.shape[0] / self.source_image_array.shape[1]
 
         # update toolbars
         self.update_navigation_toolbar()
@@ -233,163 +299,192 @@ class ImageViewer(QMainWindow):
         self.rotation_dock.show()
         self.deconvolution_dock.show()
         self.update_overlay_dock()
-        
-        deconvolution_image_array = self.deconvolve_image(self.source_image_array)
 
         # initialize the window with the source image
-        self.set_deconvolved_image(deconvolution_image_array)
-
-    def set_deconvolved_image(self, image_array: np.ndarray):
-        self.deconvolved_image_array = image_array
-
-        self.deconvolved_image = QImage(
-            self.deconvolved_image_array, 
-            self.deconvolved_image_array.shape[1], 
-            self.deconvolved_image_array.shape[0],
-            self.deconvolved_image_array.strides[0],
-            QImage.Format.Format_RGB888,     
+        self.render_scheduler.invalidate()
+        self.render_scheduler.flush()
+
+    # builds the render chain, each stage only reruns when its inputs or parameters change
+    #  source -> deconvolved -> overlay
+    # rotation and rescale are done by the canvas in one pass, and only for the visible tiles
+    def create_render_pipeline(self):
+        self.source_stage = RenderStage('source')
+
+        # optical densities of the source, only evaluated when a stain is adjusted
+        self.separated_stage = RenderStage(
+            'separated', self.separate_stains,
+            inputs=[self.source_stage],
         )
 
-        overlay_image_array = self.overlay_masks(self.deconvolved_image_array)
-
-        self.set_overlay_image(overlay_image_array)
-
-    def set_overlay_image(self, image_array: np.ndarray):
-        self.overlay_image_array = image_array
-
-        self.overlay_image = QImage(
-            self.overlay_image_array, 
-            self.overlay_image_array.shape[1], 
-            self.overlay_image_array.shape[0],
-            self.overlay_image_array.strides[0],
-            QImage.Format.Format_RGB888,     
+        self.deconvolved_stage = RenderStage(
+            'deconvolved', lambda image_array: self.deconvolve_image(image_array, self.separated_stage),
+            inputs=[self.source_stage],
+            params=self.get_deconvolution_params,
         )
-
-        rotated_image_array = self.rotate_image(self.overlay_image_array, self.rotation_angle)
-
-        self.set_rotated_image(rotated_image_array)
-
-    def set_rotated_image(self, image_array: np.ndarray):
-        self.rotated_image_array = image_array      
-
-        self.rotated_image = QImage(
-            self.rotated_image_array, 
-            self.rotated_image_array.shape[1], 
-            self.rotated_image_array.shape[0],
-            self.rotated_image_array.strides[0],
-            QImage.Format.Format_RGB888
+        # each chain keeps its last composite, so an entry change only redoes its bounding box
+        self.overlay_compositor = OverlayCompositor()
+        self.overlay_stage = RenderStage(
+            'overlay', lambda image_array: self.overlay_masks(image_array, self.overlay_compositor),
+            inputs=[self.deconvolved_stage],
+            params=self.get_overlay_params,
         )
 
-        self.rotated_aspect_ratio = self.rotated_image.height() / self.rotated_image.width()
-
-        rescaled_image_array = self.rescale_image(self.rotated_image_array, self.scale_factor)
-
-        self.set_rescaled_image(rescaled_image_array)
-
-    def set_rescaled_image(self, image_array: np.ndarray):
-        self.rescaled_image_array = image_array
-
-        self.rescaled_image = QImage(
-            self.rescaled_image_array, 
-            self.rescaled_image_array.shape[1], 
-            self.rescaled_image_array.shape[0],
-            self.rescaled_image_array.strides[0],
-            QImage.Format.Format_RGB888,
+        # same chain on a downsampled source, shown while a stain slider is moving
+        self.preview_source_stage = RenderStage(
+            'preview source', self.downsample_image,
+            inputs=[self.source_stage],
         )
-        self.set_current_image(self.rescaled_image_array)
-
-    def set_current_image(self, image_array: np.ndarray):
-        self.current_image_array = image_array
-
-        self.current_image = QImage(
-            self.current_image_array, 
-            self.current_image_array.shape[1], 
-            self.current_image_array.shape[0],
-            self.current_image_array.strides[0],
-            QImage.Format.Format_RGB888
+        self.preview_separated_stage = RenderStage(
+            'preview separated', self.separate_stains,
+            inputs=[self.preview_source_stage],
+        )
+        self.preview_deconvolved_stage = RenderStage(
+            'preview deconvolved', lambda image_array: self.deconvolve_image(image_array, self.preview_separated_stage),
+            inputs=[self.preview_source_stage],
+            params=self.get_deconvolution_params,
+        )
+        self.preview_overlay_compositor = OverlayCompositor()
+        self.preview_overlay_stage = RenderStage(
+            'preview overlay', lambda image_array: self.overlay_masks(image_array, self.preview_overlay_compositor),
+            inputs=[self.preview_deconvolved_stage],
+            params=self.get_overlay_params,
+        )
+        self.preview_active = False
+        self.preview_timer = QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(self.PREVIEW_IDLE)
+        self.preview_timer.timeout.connect(self.stop_preview)
+
+        self.displayed_params = None
+        self.displayed_image_array = None
+
+        # control changes only invalidate stages, the render runs once per event loop turn
+        self.render_scheduler = RenderScheduler(self.update_image)
+
+    def get_deconvolution_params(self):
+        return (
+            self.stain_A_enabled, tuple(self.stain_A_range),
+            self.stain_B_enabled, tuple(self.stain_B_range),
+            self.stain_C_enabled, tuple(self.stain_C_range),
         )
 
-        self.current_pixmap = QPixmap.fromImage(self.current_image)
-        self.image_label.setPixmap(self.current_pixmap)
-
-        # show the scroll area if needed
-        self.scroll_area.setVisible(True)
-
-        # update the size of the image label
-        self.image_label.adjustSize()
-
-    def rescale_image(self, image_array: np.ndarray, scale_factor: float):
-        h = int(round(scale_factor * image_array.shape[0]))
-        w = int(round(scale_factor * image_array.shape[1]))
-        rescaled_image_array = cv2.resize(image_array, dsize=(w, h), interpolation=cv2.INTER_CUBIC)
-
-        return rescaled_image_array
-
-    def rotate_image(self, image_array: np.ndarray, angle: int):
+    # only the enabled masks affect the overlay image, outlines are drawn by the canvas
+    def get_overlay_params(self):
+        params = []
+        for widget in self.overlay_dock.widget.entry_widgets:
+            if widget.get_enabled() and not widget.outlines_only:
+                params.append((
+                    widget.mask,
+                    widget.get_color(),
+                    widget.get_alpha(),
+                ))
+        return tuple(params)
+
+    # evaluates the render chain and displays the result if it changed
+    def update_image(self):
+        if self.source_stage.result is None:
+            return
+        self.render_time = time.perf_counter()
+
+        if self.preview_active:
+            stage, compositor = self.preview_overlay_stage, self.preview_overlay_compositor
+        else:
+            stage, compositor = self.overlay_stage, self.overlay_compositor
+        overlay_image_array = stage.evaluate()
+
+        # the transform is always built from the full resolution shape, so the preview
+        # is displayed in exactly the same place as the final image
+        self.display_transform = DisplayTransform(self.source_image_array.shape, self.rotation_angle, self.scale_factor)
+        rotated_w, rotated_h = self.display_transform.get_rotated_size()
+        self.rotated_aspect_ratio = rotated_h / rotated_w
+
+        params = (stage.name, stage.version, self.display_transform.get_key())
+        if params != self.displayed_params:
+
+            # the composite was updated in place from the displayed one, only redraw what changed
+            dirty_rect = None
+            if self.displayed_params == (stage.name, stage.version - 1, self.display_transform.get_key()) and \
+               overlay_image_array is self.displayed_image_array:
+                dirty_rect = compositor.dirty_rect
+
+            self.displayed_params = params
+            self.displayed_image_array = overlay_image_array
+            with profiler.span('set image', dirty=not dirty_rect is None):
+                self.set_current_image(overlay_image_array, stage, dirty_rect)
+
+        self.enforce_memory_budget()
+
+    # dirty_rect is the rect (x, y, w, h) of the image which changed since it was last displayed
+    def set_current_image(self, image_array: np.ndarray, stage: RenderStage, dirty_rect=None):
+        scale_x = image_array.shape[1] / self.source_image_array.shape[1]
+        scale_y = image_array.shape[0] / self.source_image_array.shape[0]
+        scale = (scale_x, scale_y)
+        key = (self.file_name, stage.name, stage.version)
+        if dirty_rect is None:
+            pyramid = self.pyramid_cache.get(key, image_array, scale)
+            self.canvas.set_image(pyramid, self.display_transform)
+        else:
+            previous_key = (self.file_name, stage.name, stage.version - 1)
+            pyramid = self.pyramid_cache.update(previous_key, key, image_array, dirty_rect, scale)
 
-        # get horz,vert scroll bar coord
+            # the canvas takes the rect in full resolution coords
+            x, y, w, h = dirty_rect
+            x0, y0 = math.floor(x / scale_x), math.floor(y / scale_y)
+            x1, y1 = math.ceil((x + w) / scale_x), math.ceil((y + h) / scale_y)
+            self.canvas.set_image(pyramid, self.display_transform, QRect(x0, y0, x1 - x0, y1 - y0))
 
-        # convert to coord on the image
+        # show the canvas if needed
+        self.canvas.setVisible(True)
 
-        frame = Frame(image_array)
-        M, new_w, new_h = frame.get_rotation_matrix(-angle)
-        frame.warp_affine(M, new_w, new_h)
-        rotated_image_array = frame.img
+    def downsample_image(self, image_array: np.ndarray):
+        scale = self.PREVIEW_SIZE / max(image_array.shape[:2])
+        if scale >= 1:
+            return image_array
+        w = max(1, int(round(scale * image_array.shape[1])))
+        h = max(1, int(round(scale * image_array.shape[0])))
+        return cv2.resize(image_array, dsize=(w, h), interpolation=cv2.INTER_AREA)
 
-        # transform coord using M
+    # shows the downsampled preview until the sliders have been idle for PREVIEW_IDLE
+    def start_preview(self):
+        if max(self.source_image_array.shape[:2]) > self.PREVIEW_SIZE:
+            self.preview_active = True
+            self.preview_timer.start()
 
-        # convert back to horz/vert scroll bar values and set them <- result, rotate around viewer center
+    def stop_preview(self):
+        self.preview_active = False
+        self.render_scheduler.invalidate()
 
-        return rotated_image_array
+    def separate_stains(self, image_array: np.ndarray):
+        return self.deconvolution_dock.widget.engine.separate(image_array)
 
-    def deconvolve_image(self, image_array: np.ndarray):
+    def deconvolve_image(self, image_array: np.ndarray, separated_stage: RenderStage):
         if all([self.stain_A_enabled,self.stain_B_enabled,self.stain_C_enabled]):
             return image_array
         
-        stains = self.deconvolution_dock.widget.ss.separate(image_array)
+        # the separation only depends on the source, so it is computed once per frame
+        separated_stains = separated_stage.evaluate()
 
-        if self.stain_A_enabled:
-            stains[:,:,0] = np.clip(stains[:,:,0], self.stain_A_range[0], self.stain_A_range[1])
-        else:
-            stains[:,:,0] = 0
-        if self.stain_B_enabled:
-            stains[:,:,1] = np.clip(stains[:,:,1], self.stain_B_range[0], self.stain_B_range[1])
-        else:
-            stains[:,:,1] = 0
-        if self.stain_C_enabled:
-            stains[:,:,2] = np.clip(stains[:,:,2], self.stain_C_range[0], self.stain_C_range[1])
-        else:
-            stains[:,:,2] = 0
-        deconvolved_image_array = self.deconvolution_dock.widget.ss.combine(stains)
+        # clip and recombine in stripes, leaving the separated stains untouched
+        ranges = []
+        for is_enabled, stain_range in [(self.stain_A_enabled, self.stain_A_range),
+                                        (self.stain_B_enabled, self.stain_B_range),
+                                        (self.stain_C_enabled, self.stain_C_range)]:
+            ranges.append(stain_range if is_enabled else None)
+        deconvolved_image_array = self.deconvolution_dock.widget.engine.deconvolve(separated_stains, ranges)
 
         return deconvolved_image_array
 
-    def overlay_masks(self, image_array: np.ndarray):
-        overlay_frame = Frame(image_array)
-        
+    def overlay_masks(self, image_array: np.ndarray, compositor: OverlayCompositor):
+        layers = []
         for widget in self.overlay_dock.widget.entry_widgets:
-            if widget.get_enabled():
-                if widget.outlines_only:
-
-                    # TODO: need to plot all bodies!
-                    # TODO: or just load in the annotations...
-                    if len(widget.bodies) == 0:
-                        continue
-                    overlay_frame = overlay_mask(
-                        overlay_frame, None,
-                        main_roi=widget.bodies[0].polygon,
-                        alpha=widget.get_alpha(),
-                        color=widget.get_color(),
-                        linewidth=widget.get_linewidth(),
-                    )
-                else:
-                    overlay_frame = overlay_mask(
-                        overlay_frame, widget.frame, 
-                        alpha=widget.get_alpha(), 
-                        color=widget.get_color(),
-                    )
-
-        overlay_image_array = overlay_frame.img
+            if widget.get_enabled() and not widget.outlines_only:
+
+                # the image is smaller than the masks when rendering a preview
+                mask = widget.get_mask(image_array.shape)
+                if not mask.is_empty():
+                    layers.append(OverlayLayer(mask, color=widget.get_color(), alpha=widget.get_alpha()))
+
+        overlay_image_array = compositor.composite(image_array, layers)
 
         return overlay_image_array
 
@@ -399,10 +494,13 @@ class ImageViewer(QMainWindow):
             file_name, _ = QFileDialog.getSaveFileName(self, 'QFileDialog.getSaveFileName()', '',
                                                     'Images (*.png *.jpeg *.jpg *.bmp *.gif)', options=options)
         if file_name:
-            
+
+            # make sure the latest control changes are rendered
+            self.render_scheduler.flush()
+
             # calculate the visible rect of the image
-            x = self.scroll_area.horizontalScrollBar().value()
-            y = self.scroll_area.verticalScrollBar().value()
+            x = self.canvas.horizontalScrollBar().value()
+            y = self.canvas.verticalScrollBar().value()
             w = self.width()
             h = self.height()
             if self.vertical_scroll_bar_is_visible():
@@ -412,25 +510,26 @@ class ImageViewer(QMainWindow):
             if self.navigation_toolbar.isVisible():
                 h -= self.navigation_toolbar.height()
 
-            # extract the rect from the current image        
+            # render the rect from the current image
             rect = QRect(x, y, w, h)
-            save_image = self.current_image.copy(rect)
+            _, save_image = self.canvas.render_region(rect)
 
             # save the image
-            save_image.save(file_name)
+            with profiler.span('save frame', file=file_name):
+                save_image.save(file_name)
 
     def set_scale_factor(self, scale_factor):
         self.scale_factor = scale_factor
 
-        rescaled_image_array = self.rescale_image(self.rotated_image_array, self.scale_factor)
-
-        self.set_rescaled_image(rescaled_image_array)
+        # zooming reads back the new image size, so render right away
+        self.render_scheduler.invalidate()
+        self.render_scheduler.flush()
 
     # update the scale factor by 25%, update the scroll bar values so that they do not move
     def zoom_in(self):
         self.set_scale_factor(self.scale_factor * 1.25)
         self.update_scroll_bars(1.25)
-        if max([self.current_image.width(), self.current_image.height()]) > 10000:
+        if max([self.canvas.get_image_width(), self.canvas.get_image_height()]) > 10000:
             self.zoom_in_action.setDisabled(True)
         else:
             self.zoom_in_action.setEnabled(True)
@@ -438,7 +537,7 @@ class ImageViewer(QMainWindow):
     def zoom_out(self):
         self.set_scale_factor(self.scale_factor / 1.25)
         self.update_scroll_bars(1/1.25)
-        if min([self.current_image.width(), self.current_image.height()]) < 100:
+        if min([self.canvas.get_image_width(), self.canvas.get_image_height()]) < 100:
             self.zoom_out_action.setDisabled(True)
         else:
             self.zoom_out_action.setEnabled(True)
@@ -459,18 +558,18 @@ class ImageViewer(QMainWindow):
             h -= self.TITLEBAR_HEIGHT
             if self.navigation_toolbar.isVisible():
                 h -= self.navigation_toolbar.height()
-            # if self.scroll_area.horizontalScrollBar().isVisible():
+            # if self.canvas.horizontalScrollBar().isVisible():
             #     h -= self.SCROLLBAR_EXTENT
 
             # calculate the amount to zoom based on the available desktop height
-            self.set_scale_factor(h / self.rotated_image.height())
+            self.set_scale_factor(h / self.display_transform.get_rotated_size()[1])
 
             # top left corner to move the window to center it
-            px = self.DESKTOP_RECT.width()//2 - self.current_image.width()//2
+            px = self.DESKTOP_RECT.width()//2 - self.canvas.get_image_width()//2
             py = 0
 
             screen_h = self.DESKTOP_HEIGHT - self.TITLEBAR_HEIGHT
-            screen_w = self.current_image.width()
+            screen_w = self.canvas.get_image_width()
             if self.rotation_dock.isVisible() and not self.rotation_dock.isFloating():
                 screen_w += self.rotation_dock.width()
         
@@ -480,17 +579,17 @@ class ImageViewer(QMainWindow):
             w = self.DESKTOP_WIDTH
             if self.rotation_dock.isVisible() and not self.rotation_dock.isFloating():
                 w -= self.rotation_dock.width()
-            # if self.scroll_area.verticalScrollBar().isVisible():
+            # if self.canvas.verticalScrollBar().isVisible():
             #     w -= self.SCROLLBAR_EXTENT
 
             # calculate the amount to zoom based on the available desktop width
-            self.set_scale_factor(w / self.rotated_image.width())
+            self.set_scale_factor(w / self.display_transform.get_rotated_size()[0])
 
             # top left corner to move the window to center it
             px = 0
-            py = self.DESKTOP_RECT.height()//2 - self.current_image.height()//2
+            py = self.DESKTOP_RECT.height()//2 - self.canvas.get_image_height()//2
 
-            screen_h = self.current_image.height() + self.navigation_toolbar.height()
+            screen_h = self.canvas.get_image_height() + self.navigation_toolbar.height()
             screen_w = self.DESKTOP_WIDTH
 
         # center the window on the screen
@@ -501,8 +600,8 @@ class ImageViewer(QMainWindow):
 
     # when the factor changes, need to move the scroll bars as well
     def update_scroll_bars(self, factor):
-        self.update_scroll_bar(self.scroll_area.horizontalScrollBar(), factor)
-        self.update_scroll_bar(self.scroll_area.verticalScrollBar(), factor)
+        self.update_scroll_bar(self.canvas.horizontalScrollBar(), factor)
+        self.update_scroll_bar(self.canvas.verticalScrollBar(), factor)
     def update_scroll_bar(self, scroll_bar, factor):
         scroll_bar.setValue(int(factor * scroll_bar.value()
                                + ((factor - 1) * scroll_bar.pageStep() / 2)))
@@ -510,19 +609,17 @@ class ImageViewer(QMainWindow):
 
     def set_image_rotation(self, angle):
         self.rotation_angle = angle - 180
-        
-        rotated_image_array = self.rotate_image(self.overlay_image_array, self.rotation_angle)
 
-        self.set_rotated_image(rotated_image_array)
+        self.render_scheduler.invalidate()
 
     def set_default_image_rotation(self):
         self.rotation_dial.setValue(180)
 
     # functions which see if the image dimensions surpass the MainWindow dimensions
     def horizontal_scroll_bar_is_visible(self):
-        return self.current_image.size().width() > self.width()
+        return self.canvas.get_image_width() > self.width()
     def vertical_scroll_bar_is_visible(self):
-        return self.current_image.size().height() > self.height()
+        return self.canvas.get_image_height() > self.height()
 
     def about(self):
         QMessageBox.about(self, "About Image Viewer",
@@ -541,11 +638,16 @@ class ImageViewer(QMainWindow):
     def create_actions(self):
         self.open_action = QAction("&Open Frame...", self, shortcut="Ctrl+O", triggered=self.open_frame)
         self.save_action = QAction("&Save Frame...", self, shortcut="Ctrl+S", triggered=self.save_frame)
+        self.go_to_action = QAction("&Go to ROI...", self, shortcut="Ctrl+G", triggered=self.go_to_frame)
+        self.refresh_action = QAction("&Refresh Dataset", self, shortcut="F5", triggered=self.refresh_dataset_index)
         self.exit_action = QAction("E&xit", self, shortcut="Ctrl+Q", triggered=self.quit)
         self.zoom_in_action = QAction("Zoom &In (25%)", self, shortcut="Ctrl++", triggered=self.zoom_in)
         self.zoom_out_action = QAction("Zoom &Out (25%)", self, shortcut="Ctrl+-", triggered=self.zoom_out)
         self.reset_zoom_action = QAction("&Reset Zoom", self, shortcut="Ctrl+0", triggered=self.reset_zoom)
         self.maximize_action = QAction("&Maximize", self, shortcut="Ctrl+F", triggered=self.maximize)
+        self.show_timings_action = QAction("Show &Timings", self, shortcut="Ctrl+T", checkable=True, toggled=self.set_timings_visible)
+        self.record_trace_action = QAction("Record T&race", self, checkable=True, toggled=self.set_trace_recording)
+        self.record_trace_action.setChecked(profiler.tracing)
         self.about_action = QAction("&About", self, triggered=self.about)
         self.about_qt_action = QAction("About &Qt", self, triggered=QApplication.aboutQt)
 
@@ -554,6 +656,9 @@ class ImageViewer(QMainWindow):
         self.file_menu.addAction(self.open_action)
         self.file_menu.addAction(self.save_action)
         self.file_menu.addSeparator()
+        self.file_menu.addAction(self.go_to_action)
+        self.file_menu.addAction(self.refresh_action)
+        self.file_menu.addSeparator()
         self.file_menu.addAction(self.exit_action)
 
         self.view_menu = QMenu("&View", self)
@@ -562,6 +667,9 @@ class ImageViewer(QMainWindow):
         self.view_menu.addAction(self.overlay_dock.toggleViewAction())
         self.view_menu.addAction(self.navigation_toolbar.toggleViewAction())
         self.view_menu.addAction(self.ordinal_toolbar.toggleViewAction())
+        self.view_menu.addSeparator()
+        self.view_menu.addAction(self.show_timings_action)
+        self.view_menu.addAction(self.record_trace_action)
 
         self.window_menu = QMenu("&Window", self)
         self.window_menu.addAction(self.zoom_in_action)
@@ -640,7 +748,7 @@ class ImageViewer(QMainWindow):
         self.ordinal_spinbox_actions = []
 
     def update_ordinal_toolbar(self):
-        if not self.df is None:
+        if not self.scores is None:
             self.set_ordinal_spinbox_values()
             self.update_spreadsheet()
 
@@ -660,14 +768,22 @@ class ImageViewer(QMainWindow):
 
             self.slide_column = 'SlideROI'
 
-            if file_name.endswith('.csv'):
-                self.df = pd.read_csv(file_name)
-            else:
-                self.df = pd.read_excel(file_name)
-
-            for value_column in self.df.columns:
-                if value_column == self.slide_column:
-                    continue
+            # the previous spreadsheet is autosaved before its scores are replaced
+            self.close_score_journal()
+
+            # changes since the spreadsheet was last saved are in its autosave and journal
+            self.score_journal = ScoreJournal(file_name)
+            source = self.score_journal.get_source()
+            with profiler.span('read spreadsheet', file=source):
+                df = read_spreadsheet(source)
+            self.scores = ScoreStore(df, self.slide_column)
+            n = self.score_journal.replay(self.scores)
+            if source != file_name:
+                self.statusBar().showMessage("Restored unsaved scores from %s" % source)
+            elif n != 0:
+                self.statusBar().showMessage("Recovered %d score changes from %s" % (n, self.score_journal.journal_name))
+
+            for value_column in self.scores.get_value_columns():
                 widget = LabeledSpinBoxWidget(value_column, 0)
                 widget.value_changed.connect(self.update_spreadsheet)
                 action = self.ordinal_toolbar.addWidget(widget)
@@ -677,36 +793,35 @@ class ImageViewer(QMainWindow):
             self.update_ordinal_toolbar()
 
     def set_ordinal_spinbox_values(self):
-        for value_column in self.df.columns:
-            if value_column == self.slide_column:
-                continue
-
-            idx = self.slide_name+'_'+self.roi_name
-            row_loc = self.df[self.df[self.slide_column] == idx].index
-            if len(row_loc) != 0:
-                value = self.df.loc[row_loc[0]][value_column]
-            else:
-                value = 0
-
-            widget = [widget for widget in self.ordinal_spinboxs if widget.get_label() == value_column][0]
+        idx = self.slide_name+'_'+self.roi_name
+        for widget in self.ordinal_spinboxs:
+            value = self.scores.get(idx, widget.get_label(), 0)
             widget.blockSignals(True)
             widget.set_value(value)
             widget.blockSignals(False)
 
-
     def update_spreadsheet(self):
-
         idx = self.slide_name+'_'+self.roi_name
-        if not idx in list(self.df[self.slide_column]):
-            self.df.loc[len(self.df)] = [idx,] + [0]*len(self.ordinal_spinboxs)
-
-        row_idx = self.df[self.df[self.slide_column] == idx].index[0]
-
-        for widget in self.ordinal_spinboxs:
-            column = widget.get_label()
-            value = widget.get_value()
-            self.df.at[row_idx, column] = value
-        print(self.df)
+        values = {widget.get_label(): widget.get_value() for widget in self.ordinal_spinboxs}
+        if self.scores.set(idx, values):
+            self.score_journal.append(idx, values)
+
+    # writes the scores to the autosave on a background thread
+    def compact_score_journal(self):
+        if self.score_journal is None:
+            return
+        error = self.score_journal.get_error()
+        if not error is None:
+            self.statusBar().showMessage("Autosave failed, scores are kept in %s: %s" % (self.score_journal.old_name, error))
+        if self.score_journal.dirty and not self.score_journal.is_compacting():
+            self.score_journal.compact(self.scores.to_dataframe())
+
+    # writes the changes which are not in the autosave yet, waiting for the write
+    def close_score_journal(self):
+        if not self.score_journal is None:
+            self.score_journal.flush(self.scores.to_dataframe())
+            self.score_journal.close()
+            self.score_journal = None
 
     def save_spreadsheet(self, file_name=""):
         if file_name == "" or file_name == False:
@@ -714,14 +829,125 @@ class ImageViewer(QMainWindow):
             file_name, _ = QFileDialog.getSaveFileName(self, '', '',
                                                     'Spreadsheets (*.csv *.xlsx)', options=options)
         if file_name:
-            if file_name.endswith('.csv'):
-                self.df.to_csv(file_name)
-            else:
-                self.df.to_excel(file_name)
+            write_spreadsheet(self.scores.to_dataframe(), file_name)
+
+            # the imported spreadsheet has every change now
+            if not self.score_journal is None and os.path.abspath(file_name) == os.path.abspath(self.score_journal.file_name):
+                self.score_journal.reset()
             return True
         else:
             return False
 
+    def create_timings_label(self):
+        self.render_time = 0.0
+
+        self.timings_label = QLabel()
+        self.timings_label.hide()
+        self.statusBar().addPermanentWidget(self.timings_label)
+
+        self.timings_timer = QTimer()
+        self.timings_timer.setInterval(self.TIMINGS_INTERVAL)
+        self.timings_timer.timeout.connect(self.update_timings_label)
+
+    def set_timings_visible(self, visible):
+        profiler.set_enabled(visible)
+        self.timings_label.setVisible(visible)
+        if visible:
+            self.timings_timer.start()
+            self.update_timings_label()
+        else:
+            self.timings_timer.stop()
+
+    # time, count and largest buffer of each stage since the last render started, including
+    # the tiles painted for it and any loads running meanwhile, then the memory in use
+    def update_timings_label(self):
+        items = []
+        for name, (total, count, nbytes) in summarize_spans(profiler.get_spans(self.render_time)).items():
+            item = '%s %.1fms' % (name, 1000 * total)
+            if count > 1:
+                item += ' x%d' % count
+            if nbytes > 0:
+                item += ' ' + format_nbytes(nbytes)
+            items.append(item)
+        items.append(self.get_memory_summary())
+        self.timings_label.setText(' | '.join(items))
+
+    # records every span until unchecked, then asks where to write the Chrome trace
+    def set_trace_recording(self, recording):
+        if recording:
+            if not profiler.tracing:
+                profiler.start_trace()
+            return
+        options = QFileDialog.Options()
+        file_name, _ = QFileDialog.getSaveFileName(self, '', 'trace.json', 'Chrome Trace (*.json)', options=options)
+        if file_name:
+            n = profiler.write_trace(file_name)
+            self.statusBar().showMessage("Wrote %d spans to %s" % (n, file_name))
+        else:
+            profiler.stop_trace()
+
+    # consumers in eviction order, the ones which are never evicted are only counted.
+    # what is displayed is counted first, so caches only count what they add to it
+    def create_memory_budget(self, max_bytes=None):
+        self.memory_budget = MemoryBudget(max_bytes)
+        self.evicted = []
+
+        engine = self.deconvolution_dock.widget.engine
+        self.memory_budget.add('displayed', self.get_displayed_buffers)
+        self.memory_budget.add('overlays', self.get_overlay_buffers)
+        self.memory_budget.add('buffers', engine.get_buffers, lambda nbytes: engine.clear_buffers())
+        self.memory_budget.add('tiles', lambda: [self.canvas.cache.get_nbytes()], self.canvas.cache.evict)
+        self.memory_budget.add('previews', self.get_preview_buffers, lambda nbytes: self.clear_previews())
+        self.memory_budget.add('pyramids', self.pyramid_cache.get_buffers, self.pyramid_cache.evict)
+        self.memory_budget.add('frames', self.frame_cache.get_buffers,
+                               lambda nbytes: self.frame_cache.evict(nbytes, keep=[self.file_name]))
+
+        # needed by every slider move, so it goes last
+        self.memory_budget.add('separated', lambda: [self.separated_stage.result], lambda nbytes: self.separated_stage.clear())
+
+    def get_displayed_buffers(self):
+        return [
+            self.source_stage.result, self.deconvolved_stage.result, self.overlay_stage.result,
+            self.overlay_compositor.out,
+        ]
+
+    def get_overlay_buffers(self):
+        buffers = []
+        for widget in self.overlay_dock.widget.entry_widgets:
+            for mask in [widget.mask, widget.resized_mask]:
+                if not mask is None:
+                    buffers.append(mask.get_nbytes())
+        return buffers
+
+    def get_preview_buffers(self):
+        return [
+            self.preview_source_stage.result, self.preview_separated_stage.result,
+            self.preview_deconvolved_stage.result, self.preview_overlay_stage.result,
+            self.preview_overlay_compositor.out,
+        ]
+
+    # the previews are rebuilt when a slider next moves, never while one is shown
+    def clear_previews(self):
+        if self.preview_active:
+            return
+        for stage in [self.preview_source_stage, self.preview_separated_stage,
+                      self.preview_deconvolved_stage, self.preview_overlay_stage]:
+            stage.clear()
+        self.preview_overlay_compositor.clear()
+
+    def enforce_memory_budget(self):
+        evicted = self.memory_budget.enforce()
+        if len(evicted) != 0:
+            self.evicted = evicted
+
+    def get_memory_summary(self):
+        usage = self.memory_budget.get_usage()
+        summary = 'memory %s / %s' % (format_nbytes(sum(usage.values())), format_nbytes(self.memory_budget.max_bytes))
+        summary += ' (%s)' % ', '.join('%s %s' % (name, format_nbytes(nbytes)) for name, nbytes in usage.items() if nbytes > 0)
+        if len(self.evicted) != 0:
+            summary += ', last evicted %s' % ', '.join(self.evicted)
+        return summary
+
     def create_rotation_dock(self):
         self.rotation_dock = QDockWidget("Rotation Dock")
         self.rotation_dock.hide()
@@ -765,18 +991,21 @@ class ImageViewer(QMainWindow):
             self.deconvolution_dock.widget.slider_to_od(values[0]),
             self.deconvolution_dock.widget.slider_to_od(values[1]),
         )
+        self.start_preview()
         self.update_deconvolution_image()
     def set_stain_B_range(self, values):
         self.stain_B_range = (
             self.deconvolution_dock.widget.slider_to_od(values[0]),
             self.deconvolution_dock.widget.slider_to_od(values[1]),
         )
+        self.start_preview()
         self.update_deconvolution_image()
     def set_stain_C_range(self, values):
         self.stain_C_range = (
             self.deconvolution_dock.widget.slider_to_od(values[0]),
             self.deconvolution_dock.widget.slider_to_od(values[1]),
         )
+        self.start_preview()
         self.update_deconvolution_image()
 
     def set_stain_A_enabled(self, is_enabled):
@@ -789,39 +1018,56 @@ class ImageViewer(QMainWindow):
         self.stain_C_enabled = is_enabled
         self.update_deconvolution_image()
 
+    # the stain ranges and enabled stains are the params of the deconvolved stages
     def update_deconvolution_image(self):
-
-        deconvolved_image_array = self.deconvolve_image(self.source_image_array)
-
-        self.set_deconvolved_image(deconvolved_image_array)
+        self.render_scheduler.invalidate()
 
     def create_overlay_dock(self):
         self.overlay_dock = OverlayDockWidget('Overlay Dock')
         self.overlay_dock.hide()
         self.overlay_dock.setAllowedAreas(Qt.DockWidgetArea.RightDockWidgetArea)
         self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, self.overlay_dock)
+        self.overlay_dock.widget.entry_changed.connect(self.overlay_entry_changed)
 
+    # the entries are reused across rois, keeping their colour, alpha and enabled state
     def update_overlay_dock(self):
 
         # TODO: don't show if no overlays exist
-        # TODO: use this code once upgraded
-        # if len(self.overlay_dock.widget.entry_widgets) == 0:
-        #     self.overlay_dock.widget.set_entries(self.roi_directory)
-
-        #     for widget in self.overlay_dock.widget.entry_widgets:
-        #         widget.state_changed.connect(self.update_overlay_image)
-        # else:
-        #     self.overlay_dock.widget.update_entries(self.roi_directory)
-        #     pass
-        self.overlay_dock.widget.set_entries(self.roi_directory)
-        for widget in self.overlay_dock.widget.entry_widgets:
-            widget.state_changed.connect(self.update_overlay_image)
+        self.overlay_dock.widget.update_entries(self.roi_directory, overlays=self.roi_data.overlays)
+        self.update_preloaded_masks()
+        self.overlay_compositor.clear()
+        self.preview_overlay_compositor.clear()
+        self.update_outlines()
+
+    def overlay_entry_changed(self, widget):
+        if widget.outlines_only:
+            self.update_outlines()
+        else:
+            self.update_preloaded_masks()
+            self.update_overlay_image()
+
+    # the enabled masks are loaded along with the rois on the loader threads, so
+    # that navigating doesn't decompress them on the gui thread
+    def update_preloaded_masks(self):
+        masks = (self.overlay_dock.widget.measurement, self.overlay_dock.widget.get_enabled_masks())
+        if masks == self.frame_cache.masks:
+            return
+        self.frame_cache.set_masks(*masks)
+        if self.file_name != "":
+            self.prefetch_frames()
 
 
+    # the enabled masks, colours and alphas are the params of the overlay stages
     def update_overlay_image(self):
-        overlay_image_array = self.overlay_masks(self.deconvolved_image_array)
+        self.render_scheduler.invalidate()
 
-        self.set_overlay_image(overlay_image_array)
+    # outlines are vectors drawn over the image, so changing them renders nothing
+    def update_outlines(self):
+        outlines = []
+        for widget in self.overlay_dock.widget.entry_widgets:
+            if widget.get_enabled() and widget.outlines_only and widget.get_linewidth() > 0:
+                outlines.append((widget.get_path(), QColor(*widget.get_color()), widget.get_linewidth()))
+        self.canvas.set_outlines(outlines)
 
     def rotation_dial_mouse_press_event(self, event: QMouseEvent):
         if event.button() == Qt.RightButton:
@@ -0,0 +1,90 @@
+
+import os
+
+import numpy as np
+
+# central accounting of the viewer's image buffers and caches, bounded by a budget.
+# when over budget, consumers are evicted in the order they were added, so the
+# intermediates which are cheapest to recompute go first and what is displayed is
+# never evicted. evicted buffers are recomputed when next needed
+#  -get_buffers: returns the consumer's numpy arrays, and ints for memory that isn't an
+#                array. arrays shared by consumers, e.g. the source image is both a loaded
+#                frame and a render stage result, are only counted once
+#  -evict: frees at least the given number of bytes if it can, None if never evicted
+class MemoryConsumer:
+    def __init__(self, name, get_buffers, evict=None):
+        self.name = name
+        self.get_buffers = get_buffers
+        self.evict = evict
+
+# fraction of the physical memory used by default
+DEFAULT_FRACTION = 0.5
+
+# used when the physical memory is unknown
+DEFAULT_BYTES = 8 * 1024**3
+
+def get_physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def get_default_budget():
+    physical_memory = get_physical_memory()
+    if physical_memory is None:
+        return DEFAULT_BYTES
+    return int(DEFAULT_FRACTION * physical_memory)
+
+# the array owning the memory of a view
+def get_root(array: np.ndarray):
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+class MemoryBudget:
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = get_default_budget()
+        self.max_bytes = max_bytes
+        self.consumers = []
+
+    def add(self, name, get_buffers, evict=None):
+        self.consumers.append(MemoryConsumer(name, get_buffers, evict))
+
+    # bytes of each consumer, a shared array is counted by the first consumer reporting it
+    def get_usage(self):
+        usage = {}
+        seen = set()
+        for consumer in self.consumers:
+            nbytes = 0
+            for buffer in consumer.get_buffers():
+                if buffer is None:
+                    continue
+                if not isinstance(buffer, np.ndarray):
+                    nbytes += buffer
+                    continue
+                root = get_root(buffer)
+                if not id(root) in seen:
+                    seen.add(id(root))
+                    nbytes += root.nbytes
+            usage[consumer.name] = nbytes
+        return usage
+
+    def get_nbytes(self):
+        return sum(self.get_usage().values())
+
+    # evicts consumers in order until under budget, returns the names of those evicted
+    def enforce(self):
+        evicted = []
+        nbytes = self.get_nbytes()
+        for consumer in self.consumers:
+            if nbytes <= self.max_bytes:
+                break
+            if consumer.evict is None:
+                continue
+            consumer.evict(nbytes - self.max_bytes)
+            new_nbytes = self.get_nbytes()
+            if new_nbytes < nbytes:
+                evicted.append(consumer.name)
+            nbytes = new_nbytes
+        return evicted
@@ -0,0 +1,108 @@
+
+import numpy as np
+
+from PackedMask import PackedMask
+
+# an overlay entry ready to be blended
+#  -mask: the pixels the entry covers, unpacked only where it is blended
+#  -color, alpha: the blended pixels become alpha * color + (1 - alpha) * pixel
+class OverlayLayer:
+    def __init__(self, mask: PackedMask, color, alpha):
+        self.mask = mask
+        self.x, self.y, self.w, self.h = mask.get_rect()
+        self.color = tuple(color)
+        self.alpha = alpha
+
+        # the colour premultiplied by alpha, added to the attenuated pixels
+        self.premultiplied = alpha * np.array(color, dtype=np.float32)
+
+    def get_rect(self):
+        return (self.x, self.y, self.w, self.h)
+
+    # identifies the pixels the layer covers and what it does to them, the mask
+    # is compared by identity
+    def get_state(self):
+        return (self.mask, self.color, self.alpha)
+
+# blends overlay layers over a base image, keeping the result between calls so
+# that when only some layers change, only their bounding boxes are recomposited
+class OverlayCompositor:
+    def __init__(self):
+        self.clear()
+
+    # forgets the previous composite, the next one is done in full
+    def clear(self):
+        self.base = None
+        self.out = None
+        self.states = None
+        self.rects = None
+
+        # rect (x, y, w, h) changed by the last composite, None when it was done in full
+        self.dirty_rect = None
+
+    # blends the layers, in order, over the base image
+    def composite(self, base: np.ndarray, layers):
+        states = [layer.get_state() for layer in layers]
+
+        # nothing to blend, the base is returned as is and must not be modified later
+        if len(layers) == 0:
+            self.clear()
+            return base
+
+        h, w = base.shape[:2]
+        if not base is self.base or self.out is None:
+            self.base = base
+            self.out = base.copy()
+            self.states = states
+            self.rects = {state: layer.get_rect() for state, layer in zip(states, layers)}
+            self.dirty_rect = None
+            self.blend(layers, 0, 0, w, h)
+            return self.out
+
+        rect = self.get_changed_rect(layers, states)
+        self.states = states
+        self.rects = {state: layer.get_rect() for state, layer in zip(states, layers)}
+        self.dirty_rect = rect
+        if not rect is None:
+            self.blend(layers, *rect)
+        return self.out
+
+    # union of the bounding boxes of the layers which were added, removed or changed
+    def get_changed_rect(self, layers, states):
+        rects = dict(self.rects)
+        for state, layer in zip(states, layers):
+            rects[state] = layer.get_rect()
+
+        previous, current = set(self.states), set(states)
+        changed = previous ^ current
+
+        # the blend order of the unchanged layers changed, everything under them is affected
+        common = [state for state in states if state in previous]
+        if common != [state for state in self.states if state in current]:
+            changed = previous | current
+
+        if len(changed) == 0:
+            return None
+        x0 = min(rects[state][0] for state in changed)
+        y0 = min(rects[state][1] for state in changed)
+        x1 = max(rects[state][0] + rects[state][2] for state in changed)
+        y1 = max(rects[state][1] + rects[state][3] for state in changed)
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    # restores the base within the rect, then blends every layer that intersects it
+    def blend(self, layers, x, y, w, h):
+        self.out[y:y+h, x:x+w] = self.base[y:y+h, x:x+w]
+        blend_layers(self.out, layers, x, y, w, h)
+
+# blends every layer that intersects the rect into out, in place
+def blend_layers(out: np.ndarray, layers, x, y, w, h):
+    x1, y1 = x + w, y + h
+    for layer in layers:
+        lx0, ly0 = max(x, layer.x), max(y, layer.y)
+        lx1, ly1 = min(x1, layer.x + layer.w), min(y1, layer.y + layer.h)
+        if lx1 <= lx0 or ly1 <= ly0:
+            continue
+        region = out[ly0:ly1, lx0:lx1]
+        mask = layer.mask.unpack(lx0, ly0, lx1, ly1)
+        # rounded to the nearest value rather than truncated
+        region[mask] = np.rint(layer.premultiplied + (1 - layer.alpha) * region[mask]).astype(region.dtype)
@@ -1,18 +1,156 @@
 
 import os
+import hashlib
+import threading
 
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.QtGui import QColor
+import numpy as np
+from PyQt5.QtCore import Qt, QPointF, pyqtSignal
+from PyQt5.QtGui import QColor, QPainterPath, QPolygonF
 from PyQt5.QtWidgets import QWidget, QLabel, QCheckBox, QHBoxLayout, QVBoxLayout, QDockWidget, QDoubleSpinBox, QSpinBox, QComboBox
 
 from ColorPicker import ColorPickerPushButton
 
 from sana.image import Frame
 
+from PackedMask import pack_mask
+from ContourCache import read_contours, write_contours
+from Profiler import profiler
+
 import pdnl_io
 
 from matplotlib import pyplot as plt
 
+# when True, decompressed measurement masks are kept as .npy files in SIDECAR_DIRECTORY,
+# and are memory mapped on later opens instead of being decompressed again. off by
+# default since they take the full uncompressed size of every mask, see main.py -sidecars
+USE_SIDECARS = False
+
+# a user cache directory, the data directory can be read only or on network storage
+SIDECAR_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'ImageViewer', 'sidecars')
+
+# roi outline entries, (keyword in the file suffix, entry label, default color)
+ROI_ENTRIES = [
+    ('MAIN', 'MAIN_ROI', 'black'),
+    ('SUB', 'SUB_ROI', 'gray'),
+    ('IGNORE', 'IGNORE_ROI', 'black'),
+]
+
+# finds the roi outline files in an roi directory, as (filename, label, default color)
+def get_roi_files(d):
+    roi_files = []
+    for f in os.listdir(d):
+        if f.endswith('.npz'):
+            suffix = pdnl_io.get_slide_suffix(f)
+            for keyword, label, default_color in ROI_ENTRIES:
+                if keyword in suffix:
+                    roi_files.append((os.path.join(d, f), label, default_color))
+    return roi_files
+
+def get_measurements(d):
+    measurements = []
+    for measurement_d in sorted(os.listdir(d)):
+        if measurement_d != 'AO':
+            continue
+        if os.path.isdir(os.path.join(d, measurement_d)):
+            measurements.append(measurement_d)
+    return measurements
+
+# finds the overlay files of a measurement, as (filename, suffix)
+def get_overlay_files(d, measurement):
+    overlay_files = []
+    for f in os.listdir(os.path.join(d, measurement)):
+        if f.endswith('.npz'):
+            suffix = pdnl_io.get_slide_suffix(f)
+            overlay_files.append((os.path.join(d, measurement, f), suffix))
+    return overlay_files
+
+# the measurement shown for an roi, the given one when the roi has it, otherwise the first
+def choose_measurement(measurements, measurement):
+    if not measurement in measurements:
+        measurement = measurements[0] if len(measurements) != 0 else ""
+    return measurement
+
+# the mask files of the given entry labels, in the measurement the dock would show for the roi
+def get_mask_files(d, measurement, labels):
+    if len(labels) == 0:
+        return []
+    measurement = choose_measurement(get_measurements(d), measurement)
+    if measurement == "":
+        return []
+    return [filename for filename, suffix in get_overlay_files(d, measurement) if suffix in labels]
+
+# named by the absolute path of the .npz, so masks with the same name in other rois don't collide
+def get_sidecar_filename(filename):
+    key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(SIDECAR_DIRECTORY, key + '.npy')
+
+# reads the mask array of an .npz, through its sidecar if it is up to date. outline
+# masks have their contours cached instead, so they don't use sidecars
+def load_mask_array(filename, use_sidecar=True):
+    if not USE_SIDECARS or not use_sidecar:
+        return Frame(filename).img
+
+    sidecar = get_sidecar_filename(filename)
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+            return np.load(sidecar, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+
+    mask = Frame(filename).img
+    write_sidecar(sidecar, mask)
+    return mask
+
+# writes to a temporary file first so that a partial sidecar is never read,
+# a cache directory which can't be written just means there is no sidecar
+def write_sidecar(sidecar, mask):
+
+    # the loader threads and the gui thread can write the same sidecar at once,
+    # so the temporary file is unique per thread, not just per process
+    tmp = '%s.%d.%d.tmp' % (sidecar, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(SIDECAR_DIRECTORY, exist_ok=True)
+        with open(tmp, 'wb') as fp:
+            np.save(fp, np.asarray(mask))
+        os.replace(tmp, sidecar)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+# contours of an outline mask, traced only if they are not in the contour cache
+def load_contours(filename):
+    contours = read_contours(filename)
+    if contours is None:
+        with profiler.span('trace contours', file=filename):
+            contours = Frame(load_mask_array(filename, use_sidecar=False)).get_contours()
+        write_contours(filename, *contours)
+    bodies, holes = contours
+    return tuple(bodies), tuple(holes)
+
+# loads the data for an entry as (mask, bodies, holes), this is safe to call off the gui thread
+#  -mask: the mask packed to bits, see PackedMask. None for outlines
+#  -bodies, holes: the contours of the mask, only for outlines
+def load_overlay(filename, outlines_only):
+    with profiler.span('load overlay', file=filename) as span:
+        if outlines_only:
+            bodies, holes = load_contours(filename)
+            return None, bodies, holes
+        mask = pack_mask(load_mask_array(filename))
+        span.set(nbytes=mask.get_nbytes())
+        return mask, None, None
+
+# one path of every contour, in source image coords
+def get_outline_path(contours):
+    path = QPainterPath()
+    for contour in contours:
+        polygon = np.asarray(contour.polygon, dtype=np.float64)
+        if len(polygon) == 0:
+            continue
+        path.addPolygon(QPolygonF([QPointF(x, y) for x, y in polygon]))
+        path.closeSubpath()
+    return path
+
 class OverlayDockWidget(QDockWidget):
     def __init__(self, name=""):
         super().__init__(name)
@@ -27,6 +165,9 @@ class OverlayWidget(QWidget):
         'HORIZONTAL_THRESH',
         'VERTICAL_THRESH',
     ]
+    # emitted with the entry whenever the state of an entry changes
+    entry_changed = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
 
@@ -37,48 +178,77 @@ class OverlayWidget(QWidget):
         self.measurements_widget = QComboBox()
         self.entry_layout.addWidget(self.measurements_widget)
 
+        self.d = None
+        self.measurements = []
+        self.measurement = ""
         self.entry_widgets = []
 
-
-    def set_entries(self, d, measurement=""):
+    # reconciles the entries with the files of a roi directory, so the dock is reused
+    # across navigation. entries are matched by label, a matching entry keeps its
+    # widget with its colour, alpha and enabled state and only has its file swapped,
+    # entries without a match are deleted and new ones are created
+    #  -measurement: measurement to show, by default the current one is kept if possible
+    #  -overlays: preloaded entry data by filename, see FrameCache
+    def update_entries(self, d, measurement="", overlays=None):
+        if overlays is None:
+            overlays = {}
         self.d = d
-
-        # clear the widgets
-        for widget in self.entry_widgets:
+        self.set_measurements(d, measurement)
+
+        # (filename, label, outlines_only, default_color) of every entry, in display order
+        entries = self.get_roi_entries(d) + self.get_overlay_entries(d, self.measurement)
+
+        widgets = {widget.get_label(): widget for widget in self.entry_widgets}
+        entry_widgets = []
+        for filename, label, outlines_only, default_color in entries:
+            widget = widgets.pop(label, None)
+            if not widget is None and widget.outlines_only != outlines_only:
+                self.delete_entry(widget)
+                widget = None
+            if widget is None:
+                widget = self.create_entry(filename, label, outlines_only, default_color, overlays.get(filename))
+            else:
+                widget.set_file(filename, overlays.get(filename))
+            entry_widgets.append(widget)
+        for widget in widgets.values():
+            self.delete_entry(widget)
+
+        # the layout follows the entry order, after the measurements
+        for i, widget in enumerate(entry_widgets):
             self.entry_layout.removeWidget(widget)
-            # TODO: delete widget?
-        self.entry_widgets = []
+            self.entry_layout.insertWidget(i + 1, widget)
+        self.entry_widgets = entry_widgets
+
+    # the labels of the enabled mask entries, see FrameCache.set_masks
+    def get_enabled_masks(self):
+        return frozenset(widget.get_label() for widget in self.entry_widgets if widget.get_enabled() and not widget.outlines_only)
 
-        self.set_roi_entries(d)
+    def get_roi_entries(self, d):
+        return [(filename, label, True, default_color) for filename, label, default_color in get_roi_files(d)]
+
+    # TODO: support soma centers
+    # TODO: support grayscale?
+    def get_overlay_entries(self, d, measurement):
         if measurement == "":
-            self.set_measurements(d)
-            measurement = self.measurements[0]
-        self.set_overlay_entries(d, measurement)
-
-    def set_roi_entries(self, d):
-        for f in os.listdir(d):
-            if f.endswith('.npz'):
-                suffix = pdnl_io.get_slide_suffix(f)
-                if 'MAIN' in suffix:
-                    widget = OverlayEntryWidget(os.path.join(d, f), 'MAIN_ROI', outlines_only=True, default_color='black')
-                    self.entry_layout.addWidget(widget)
-                    self.entry_widgets.append(widget)
-                if 'SUB' in suffix:
-                    widget = OverlayEntryWidget(os.path.join(d, f), 'SUB_ROI', outlines_only=True, default_color='gray')
-                    self.entry_layout.addWidget(widget)
-                    self.entry_widgets.append(widget)
-                if 'IGNORE' in suffix:
-                    widget = OverlayEntryWidget(os.path.join(d, f), 'IGNORE_ROI', outlines_only=True, default_color='black')
-                    self.entry_layout.addWidget(widget)
-                    self.entry_widgets.append(widget)
-
-    def set_measurements(self, d):
-        self.measurements = []
-        for measurement_d in sorted(os.listdir(d)):
-            if measurement_d != 'AO':
-                continue
-            if os.path.isdir(os.path.join(d, measurement_d)):
-                self.measurements.append(measurement_d)
+            return []
+        return [(filename, suffix, False, 'red') for filename, suffix in get_overlay_files(d, measurement)]
+
+    def create_entry(self, filename, label, outlines_only, default_color, data=None):
+        widget = OverlayEntryWidget(filename, label, outlines_only=outlines_only, default_color=default_color, data=data)
+        widget.state_changed.connect(lambda widget=widget: self.entry_changed.emit(widget))
+        return widget
+
+    def delete_entry(self, widget):
+        self.entry_layout.removeWidget(widget)
+        widget.hide()
+        widget.deleteLater()
+
+    # keeps the current measurement when the roi has it, otherwise uses the first one
+    def set_measurements(self, d, measurement=""):
+        self.measurements = get_measurements(d)
+        if measurement == "":
+            measurement = self.measurement
+        self.measurement = choose_measurement(self.measurements, measurement)
 
         try:
             self.measurements_widget.currentTextChanged.disconnect()
@@ -86,80 +256,17 @@ class OverlayWidget(QWidget):
             pass
         self.measurements_widget.clear()
         self.measurements_widget.addItems(self.measurements)
-        self.measurements_widget.currentTextChanged.connect(self.update_overlay_entries_wrapper)
+        self.measurements_widget.setCurrentText(self.measurement)
+        self.measurements_widget.currentTextChanged.connect(self.set_measurement)
 
-    # TODO: support soma centers
-    # TODO: support grayscale?
-    def set_overlay_entries(self, d, measurement):
-
-        # find the files
-        overlay_files = []
-        for f in os.listdir(os.path.join(d, measurement)):
-            if f.endswith('.npz'):
-                suffix = pdnl_io.get_slide_suffix(f)
-                overlay_files.append((suffix, f))
-
-        # create the widgets
-        for suffix, f in overlay_files:
-            widget = OverlayEntryWidget(os.path.join(d, measurement, f), suffix)
-            self.entry_layout.addWidget(widget)
-            self.entry_widgets.append(widget)
-
-    # TODO: eventually merge set and update after upgrading the functions
-    def update_entries(self, d):
-        self.d = d 
-        self.set_roi_entries(d)
-        self.set_measurements(d)
-        self.set_overlay_entries(d, self.measurements[0])
-        # self.update_roi_entries(d)
-        # self.set_measurements(d)
-        # self.update_overlay_entries(d, self.measurements[0])
-    
-    # TODO: delete entries that don't amtch
-    # TODO: add entries that don't already exist
-    def update_roi_entries(self, d):
-        for f in os.listdir(d):
-            if f.endswith('.npz'):
-                suffix = pdnl_io.get_slide_suffix(f)
-                if 'MAIN' in suffix:
-                    for widget in self.entry_widgets:
-                        if widget.get_label() == 'MAIN_ROI':
-                            widget.load_frame(os.path.join(d, f))
-                            break
-                if 'SUB' in suffix:
-                    for widget in self.entry_widgets:
-                        if widget.get_label() == 'SUB_ROI':
-                            widget.load_frame(os.path.join(d, f))
-                            break
-                if 'IGNORE' in suffix:
-                    for widget in self.entry_widgets:
-                        if widget.get_label() == 'IGNORE_ROI':
-                            widget.load_frame(os.path.join(d, f))
-                            break
-            # TODO: delete entries that don't match
-
-    # TODO: update this once upgraded
-    def update_overlay_entries_wrapper(self, measurement):
-        d = self.d
-        self.set_entries(d, measurement=measurement)
-        # self.update_overlay_entries(d, measurement)
-
-    def update_overlay_entries(self, d, measurement):
-        for f in os.listdir(os.path.join(d, measurement)):
-            if f.endswith('.npz'):
-                suffix = pdnl_io.get_slide_suffix(f)
-                for widget in self.entry_widgets:
-                    print(widget.get_label(), suffix)
-                    if widget.get_label() == suffix:
-                        print('aslkdjffajsdljklfds')
-                        widget.load_frame(os.path.join(d, measurement, f))
-        # TODO: delete entries that don't match
+    def set_measurement(self, measurement):
+        self.update_entries(self.d, measurement=measurement)
 
 # TODO: needs a up/down arrow that sends a signal to re-order the widgets
 class OverlayEntryWidget(QWidget):
     state_changed = pyqtSignal()
 
-    def __init__(self, filename, suffix, outlines_only=False, default_color='red'):
+    def __init__(self, filename, suffix, outlines_only=False, default_color='red', data=None):
         super().__init__()
 
         self.outlines_only = outlines_only
@@ -167,14 +274,20 @@ class OverlayEntryWidget(QWidget):
         self.main_layout = QHBoxLayout()
         self.setLayout(self.main_layout)
 
-        self.load_frame(filename)
+        # the mask is only read when the entry is first enabled, unless it was preloaded
+        self.filename = filename
+        self.mask, self.bodies, self.holes = None, None, None
+        self.resized_mask = None
+        self.path = None
+        if not data is None:
+            self.load_frame(filename, data)
 
         self.checkbox = QCheckBox()
         if self.outlines_only and False:
             self.checkbox.setChecked(True)
         else:
             self.checkbox.setChecked(False)
-        self.checkbox.stateChanged.connect(self.state_changed.emit)
+        self.checkbox.stateChanged.connect(self.enabled_changed)
         self.main_layout.addWidget(self.checkbox)
 
         self.colorpicker = ColorPickerPushButton(default_color, suffix)
@@ -196,10 +309,55 @@ class OverlayEntryWidget(QWidget):
         self.spinbox.valueChanged.connect(self.state_changed.emit)
         self.main_layout.addWidget(self.spinbox)
 
-    def load_frame(self, filename):
-        self.frame = Frame(filename)
+    # points the entry at the same kind of file in another roi, keeping its colour, alpha
+    # and enabled state. the data is only read right away if the entry is enabled
+    def set_file(self, filename, data=None):
+        if filename == self.filename and self.is_loaded():
+            return
+        self.filename = filename
+        self.mask, self.bodies, self.holes = None, None, None
+        self.resized_mask = None
+        self.path = None
+        if not data is None or self.get_enabled():
+            self.load_frame(filename, data)
+
+    # data is the preloaded result of load_overlay, if available
+    def load_frame(self, filename, data=None):
+        if data is None:
+            data = load_overlay(filename, self.outlines_only)
+        self.filename = filename
+        self.mask, self.bodies, self.holes = data
+        self.resized_mask = None
+        self.path = None
+
+    def is_loaded(self):
         if self.outlines_only:
-            self.bodies, self.holes = self.frame.get_contours()
+            return not self.bodies is None
+        return not self.mask is None
+
+    def load(self):
+        if not self.is_loaded():
+            self.load_frame(self.filename)
+
+    # loads the mask before anything sees the entry as enabled
+    def enabled_changed(self):
+        if self.get_enabled():
+            self.load()
+        self.state_changed.emit()
+
+    # the mask resampled to the given image shape, for previews on a downsampled image
+    def get_mask(self, shape):
+        if self.mask.shape == tuple(shape[:2]):
+            return self.mask
+        if self.resized_mask is None or self.resized_mask.shape != tuple(shape[:2]):
+            self.resized_mask = self.mask.resize(shape)
+        return self.resized_mask
+
+    # the outline as one path of every body and hole, in source image coords
+    def get_path(self):
+        if self.path is None:
+            self.path = get_outline_path(self.bodies + self.holes)
+        return self.path
 
     def get_label(self):
         return self.colorpicker.text()
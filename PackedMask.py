@@ -0,0 +1,85 @@
+
+import numpy as np
+
+# binary mask stored as packed bits, cropped to the bounding box of its set pixels.
+# this is 1 bit per pixel of the bounding box instead of 1 or more bytes per pixel
+# of the image, regions are unpacked on demand when they are blended
+#  -packed: (h, ceil(w / 8)) uint8, row major bits of the cropped mask
+#  -x, y, w, h: bounding box of the mask in the image
+#  -shape: (h, w) of the image
+class PackedMask:
+    def __init__(self, packed: np.ndarray, x, y, w, h, shape):
+        self.packed = packed
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.shape = tuple(shape[:2])
+
+    def is_empty(self):
+        return self.w == 0 or self.h == 0
+
+    def get_rect(self):
+        return (self.x, self.y, self.w, self.h)
+
+    def get_nbytes(self):
+        return self.packed.nbytes
+
+    # boolean mask of the region [x0, x1) x [y0, y1), which must be within the bounding box
+    def unpack(self, x0, y0, x1, y1):
+
+        # unpack the whole bytes covering the region, then drop the extra bits
+        bx0 = (x0 - self.x) // 8
+        bx1 = (x1 - self.x + 7) // 8
+        bits = np.unpackbits(self.packed[y0 - self.y:y1 - self.y, bx0:bx1], axis=1)
+        offset = x0 - self.x - bx0 * 8
+        return bits[:, offset:offset + x1 - x0].view(bool)
+
+    # the mask resampled to another image shape, same as cv2.resize with INTER_NEAREST
+    def resize(self, shape):
+        h, w = self.shape
+        dst_h, dst_w = shape[:2]
+        if (dst_h, dst_w) == (h, w):
+            return self
+
+        # source pixel of each destination pixel, only those in the bounding box are kept
+        src_x = np.minimum(np.floor(np.arange(dst_w) * (1.0 / (dst_w / w))).astype(np.int64), w - 1)
+        src_y = np.minimum(np.floor(np.arange(dst_h) * (1.0 / (dst_h / h))).astype(np.int64), h - 1)
+        dst_x = np.flatnonzero((src_x >= self.x) & (src_x < self.x + self.w))
+        dst_y = np.flatnonzero((src_y >= self.y) & (src_y < self.y + self.h))
+        if len(dst_x) == 0 or len(dst_y) == 0:
+            return PackedMask(np.zeros((0, 0), dtype=np.uint8), 0, 0, 0, 0, shape)
+
+        rows = np.unpackbits(self.packed[src_y[dst_y] - self.y], axis=1)
+        mask = rows[:, src_x[dst_x] - self.x]
+        return pack_mask(mask, shape, dst_x[0], dst_y[0])
+
+# packs the pixels > 0 of a mask, in stripes so the full size boolean mask is never built
+#  -shape, x, y: when mask_array is a crop, the image shape and the position of the crop
+def pack_mask(mask_array: np.ndarray, shape=None, x=0, y=0, chunk_rows=1024):
+    mask_array = np.asarray(mask_array)
+    if mask_array.ndim == 3:
+        mask_array = mask_array[:, :, 0]
+    h, w = mask_array.shape
+    if shape is None:
+        shape = (h, w)
+
+    # bounding box of the set pixels
+    rows = np.zeros(h, dtype=bool)
+    cols = np.zeros(w, dtype=bool)
+    for y0 in range(0, h, chunk_rows):
+        chunk = mask_array[y0:y0 + chunk_rows] > 0
+        rows[y0:y0 + chunk.shape[0]] = chunk.any(axis=1)
+        cols |= chunk.any(axis=0)
+    rows, cols = np.flatnonzero(rows), np.flatnonzero(cols)
+    if len(rows) == 0:
+        return PackedMask(np.zeros((0, 0), dtype=np.uint8), 0, 0, 0, 0, shape)
+    y0, y1 = int(rows[0]), int(rows[-1]) + 1
+    x0, x1 = int(cols[0]), int(cols[-1]) + 1
+
+    packed = np.empty((y1 - y0, (x1 - x0 + 7) // 8), dtype=np.uint8)
+    for i in range(y0, y1, chunk_rows):
+        j = min(y1, i + chunk_rows)
+        packed[i - y0:j - y0] = np.packbits(mask_array[i:j, x0:x1] > 0, axis=1)
+
+    return PackedMask(packed, x + x0, y + y0, x1 - x0, y1 - y0, shape)
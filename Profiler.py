@@ -0,0 +1,146 @@
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+# opt-in timing of the render chain and file i/o. nothing is recorded unless the
+# timings readout is shown or a trace is being recorded, span then returns a shared
+# no-op so the instrumented calls cost nothing
+#  -recent spans are kept for the timings readout in the status bar
+#  -while tracing, spans are kept for a Chrome trace, see write_trace. a long trace keeps
+#   only its latest MAX_TRACE_EVENTS spans, so tracing can be left on
+
+# a timed block, extra args such as the size of the result can be set before it ends
+class Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.t0, time.perf_counter(), self.args)
+        return False
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Profiler:
+
+    # spans kept for the readout, older ones are dropped
+    MAX_RECENT = 4096
+
+    # spans kept for the trace, the oldest are dropped. each is a few hundred bytes
+    MAX_TRACE_EVENTS = 250000
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.lock = threading.Lock()
+
+        # trace timestamps are relative to this
+        self.t0 = time.perf_counter()
+
+        # (name, t0, t1, args)
+        self.recent = deque(maxlen=self.MAX_RECENT)
+
+        # chrome trace events, and the names of the threads they were recorded on
+        self.trace_events = deque(maxlen=self.MAX_TRACE_EVENTS)
+        self.trace_threads = {}
+
+    def is_active(self):
+        return self.enabled or self.tracing
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            with self.lock:
+                self.recent.clear()
+
+    # times a block, e.g. with profiler.span('decode', file=file_name): ...
+    def span(self, name, **args):
+        if not self.enabled and not self.tracing:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    # called from any thread, frames are loaded and spreadsheets written off the gui thread
+    def add(self, name, t0, t1, args):
+        with self.lock:
+            if self.enabled:
+                self.recent.append((name, t0, t1, args))
+            if self.tracing:
+                thread = threading.current_thread()
+                self.trace_threads[thread.ident] = thread.name
+                self.trace_events.append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                    'ts': (t0 - self.t0) * 1e6, 'dur': (t1 - t0) * 1e6, 'args': args,
+                })
+
+    # spans which started at or after t, as (name, t0, t1, args)
+    def get_spans(self, t=0.0):
+        with self.lock:
+            return [span for span in self.recent if span[1] >= t]
+
+    def start_trace(self):
+        with self.lock:
+            self.trace_events.clear()
+            self.trace_threads = {}
+            self.tracing = True
+
+    # stops tracing and writes the events as a Chrome trace, which can be opened in
+    # chrome://tracing or ui.perfetto.dev. returns the number of spans written
+    def write_trace(self, file_name):
+        with self.lock:
+            self.tracing = False
+            spans = list(self.trace_events)
+            threads = self.trace_threads
+            self.trace_events.clear()
+            self.trace_threads = {}
+        events = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name},
+        } for ident, name in threads.items()]
+        with open(file_name, 'w') as fp:
+            json.dump({'traceEvents': events + spans, 'displayTimeUnit': 'ms'}, fp)
+        return len(spans)
+
+    # drops the trace without writing it
+    def stop_trace(self):
+        with self.lock:
+            self.tracing = False
+            self.trace_events.clear()
+            self.trace_threads = {}
+
+# total time, count and largest result size of each span name, in order of first appearance
+def summarize_spans(spans):
+    summary = {}
+    for name, t0, t1, args in spans:
+        total, count, nbytes = summary.get(name, (0.0, 0, 0))
+        summary[name] = (total + t1 - t0, count + 1, max(nbytes, args.get('nbytes', 0)))
+    return summary
+
+def format_nbytes(nbytes):
+    if nbytes >= 1024**3:
+        return '%.1fGB' % (nbytes / 1024**3)
+    if nbytes >= 1024**2:
+        return '%.0fMB' % (nbytes / 1024**2)
+    return '%.0fKB' % (nbytes / 1024)
+
+# shared by the whole process, so loader threads and the gui record into the same timeline
+profiler = Profiler()
@@ -0,0 +1,68 @@
+
+from Profiler import profiler
+
+# a single step of the render chain, e.g. deconvolution or rotation
+#  -function: computes the result from the results of the input stages
+#  -inputs: upstream stages whose results are passed to the function
+#  -params: returns a hashable key of the parameters the function depends on
+class RenderStage:
+    def __init__(self, name, function=None, inputs=(), params=None):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = params
+
+        self.result = None
+        self.key = None
+        self.input_versions = None
+
+        # incremented every time the result changes, used by downstream stages
+        self.version = 0
+
+        self.dirty = True
+
+    # forces a recompute on the next evaluate, for changes not captured by params
+    def invalidate(self):
+        self.dirty = True
+
+    # source stages have no function, their result is set directly
+    def set_result(self, result):
+        self.result = result
+        self.version += 1
+        self.dirty = False
+
+    def get_key(self):
+        if self.params is None:
+            return None
+        return self.params()
+
+    def is_dirty(self):
+        if self.function is None:
+            return False
+        if self.dirty or self.result is None:
+            return True
+        if tuple(stage.version for stage in self.inputs) != self.input_versions:
+            return True
+        return self.get_key() != self.key
+
+    # evaluates the upstream stages, then recomputes this stage only if needed
+    def evaluate(self):
+        if self.function is None:
+            return self.result
+
+        input_results = [stage.evaluate() for stage in self.inputs]
+
+        if self.is_dirty():
+            self.key = self.get_key()
+            self.input_versions = tuple(stage.version for stage in self.inputs)
+            with profiler.span(self.name) as span:
+                self.set_result(self.function(*input_results))
+                span.set(nbytes=getattr(self.result, 'nbytes', 0))
+
+        return self.result
+
+    def clear(self):
+        self.result = None
+        self.key = None
+        self.input_versions = None
+        self.dirty = True
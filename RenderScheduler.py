@@ -0,0 +1,55 @@
+
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+
+from RenderPipeline import RenderStage
+
+# coalesces invalidations into at most one render per event loop turn, and no more
+# than one per frame interval. the render reads the latest state when it runs, so
+# values made redundant by newer ones are never rendered
+class RenderScheduler(QObject):
+
+    # minimum time between renders in ms, about one display frame
+    INTERVAL = 16
+
+    def __init__(self, render):
+        super().__init__()
+
+        self.render = render
+
+        # True when something changed since the last render, the stages work out
+        # themselves what to recompute from their params and input versions
+        self.pending = False
+
+        self.last_render_time = 0.0
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.run)
+
+    # schedules a render. a stage is only given for changes its params don't capture,
+    # it is then recomputed even if its params are the same
+    def invalidate(self, stage: RenderStage = None):
+        if not stage is None:
+            stage.invalidate()
+        self.pending = True
+
+        if not self.timer.isActive():
+            elapsed = (time.perf_counter() - self.last_render_time) * 1000
+            self.timer.start(max(0, int(self.INTERVAL - elapsed)))
+
+    def is_pending(self):
+        return self.pending
+
+    # renders now if anything is invalid, used before reading the rendered state
+    def flush(self):
+        self.timer.stop()
+        self.run()
+
+    def run(self):
+        if not self.is_pending():
+            return
+        self.pending = False
+        self.last_render_time = time.perf_counter()
+        self.render()
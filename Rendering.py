@@ -0,0 +1,91 @@
+
+import math
+
+import cv2
+import numpy as np
+from sana.image import Frame
+
+# 3x3 matrix which rescales pixel coordinates, using the same pixel center
+# convention as cv2.resize so that adjacent regions line up exactly
+#  -scale_y: when the axes are scaled differently, by default the same as scale_x
+def get_scale_matrix(scale_x: float, scale_y: float = None):
+    if scale_y is None:
+        scale_y = scale_x
+    return np.array([
+        [scale_x, 0, 0.5 * scale_x - 0.5],
+        [0, scale_y, 0.5 * scale_y - 0.5],
+        [0, 0, 1],
+    ], dtype=np.float64)
+
+def get_translation_matrix(x: float, y: float):
+    return np.array([
+        [1, 0, x],
+        [0, 1, y],
+        [0, 0, 1],
+    ], dtype=np.float64)
+
+# maps the source image to the displayed image, rotating then rescaling it
+#  -angle: rotation in degrees, as set by the rotation dial
+#  -scale_factor: zoom applied after the rotation
+class DisplayTransform:
+    def __init__(self, shape, angle: float, scale_factor: float):
+        self.shape = tuple(shape[:2])
+        self.angle = angle
+        self.scale_factor = scale_factor
+
+        # rotation matrix and rotated size from Frame, which only needs the image size,
+        # so a zero-strided view is used instead of the image itself
+        h, w = self.shape
+        if self.angle == 0:
+            M, self.rotated_w, self.rotated_h = np.eye(3)[:2], w, h
+        else:
+            size_array = np.broadcast_to(np.zeros((1, 1, 3), dtype=np.uint8), (h, w, 3))
+            M, self.rotated_w, self.rotated_h = Frame(size_array).get_rotation_matrix(-self.angle)
+        self.rotation_matrix = np.vstack([np.asarray(M, dtype=np.float64)[:2], [0, 0, 1]])
+
+        self.matrix = get_scale_matrix(self.scale_factor) @ self.rotation_matrix
+
+    def get_key(self):
+        return (self.angle, self.scale_factor)
+
+    def get_rotated_size(self):
+        return self.rotated_w, self.rotated_h
+
+    # size of the displayed image, matches the dsize cv2.resize would be given
+    def get_size(self):
+        w = max(1, int(round(self.scale_factor * self.rotated_w)))
+        h = max(1, int(round(self.scale_factor * self.rotated_h)))
+        return w, h
+
+    # matrix from a pyramid level to the region of the display starting at (x, y)
+    #  -level_scale: (scale_x, scale_y) of the level, see ImagePyramid.get_level_scale
+    def get_region_matrix(self, level_scale, x: int, y: int):
+        level_to_source = np.linalg.inv(get_scale_matrix(*level_scale))
+        return (get_translation_matrix(-x, -y) @ self.matrix @ level_to_source)[:2]
+
+    # bounding box (x, y, w, h) of a source image rect after it is displayed
+    def map_rect(self, x: int, y: int, w: int, h: int):
+        corners = np.array([
+            [x, y, 1], [x + w, y, 1], [x, y + h, 1], [x + w, y + h, 1],
+        ], dtype=np.float64).T
+        mapped = self.matrix @ corners
+        x0, y0 = math.floor(mapped[0].min()), math.floor(mapped[1].min())
+        x1, y1 = math.ceil(mapped[0].max()), math.ceil(mapped[1].max())
+        return x0, y0, x1 - x0, y1 - y0
+
+# resamples the region [x, x+w) x [y, y+h) of the displayed image directly from a
+# pyramid level, rotation and zoom are applied in a single interpolation pass
+def render_region(level_array: np.ndarray, level_scale, transform: DisplayTransform, x: int, y: int, w: int, h: int):
+    M = transform.get_region_matrix(level_scale, x, y)
+
+    # replicate the edges when not rotating, this matches cv2.resize
+    if transform.angle == 0:
+        border_mode = cv2.BORDER_REPLICATE
+    else:
+        border_mode = cv2.BORDER_CONSTANT
+
+    return cv2.warpAffine(
+        level_array, M, dsize=(w, h),
+        flags=cv2.INTER_CUBIC,
+        borderMode=border_mode,
+    )
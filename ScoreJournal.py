@@ -0,0 +1,152 @@
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from ScoreStore import ScoreStore
+from Profiler import profiler
+
+def read_spreadsheet(file_name):
+    if file_name.endswith('.csv'):
+        return pd.read_csv(file_name)
+    return pd.read_excel(file_name)
+
+# spreadsheets are written without the index, so they can be imported again as is
+def write_spreadsheet(df: pd.DataFrame, file_name):
+    if file_name.endswith('.csv'):
+        df.to_csv(file_name, index=False)
+    else:
+        df.to_excel(file_name, index=False)
+
+# write ahead journal of the score changes of a spreadsheet, so that a crash never
+# loses scores and a change costs one appended line instead of rewriting the file.
+# the imported spreadsheet itself is only written by an explicit save
+#  -file_name.journal: one json line per change, {"key": roi, "values": {column: score}}
+#  -file_name.journal.old: the changes being compacted into the autosave
+#  -name.autosave.csv: a snapshot of the scores, read instead of the spreadsheet
+#                      while it is newer
+#
+# compacting rotates the journal, then writes the autosave on a background thread
+# and deletes the rotated journal once the autosave is safely replaced. replaying
+# a change twice is harmless, so a crash at any point only leaves extra lines
+class ScoreJournal:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.journal_name = file_name + '.journal'
+        self.old_name = self.journal_name + '.old'
+        self.autosave_name = os.path.splitext(file_name)[0] + '.autosave.csv'
+
+        self.fp = self.open_journal()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+        # True when there are changes which are not in the autosave yet
+        self.dirty = os.path.exists(self.old_name) or os.path.getsize(self.journal_name) != 0
+
+    # the file to import the scores from, the autosave unless the spreadsheet was written since
+    def get_source(self):
+        if os.path.exists(self.autosave_name) and os.path.getmtime(self.autosave_name) >= os.path.getmtime(self.file_name):
+            return self.autosave_name
+        return self.file_name
+
+    # applies the journaled changes to the scores, returns the number of changes
+    def replay(self, scores: ScoreStore):
+        n = 0
+        for name in [self.old_name, self.journal_name]:
+            if not os.path.exists(name):
+                continue
+            with open(name) as fp:
+                for line in fp:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+
+                        # a line cut off by a crash
+                        continue
+                    scores.set(change['key'], change['values'])
+                    n += 1
+        return n
+
+    def append(self, key, values: dict):
+        self.fp.write(json.dumps({'key': key, 'values': values}) + '\n')
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.dirty = True
+
+    # True when the spreadsheet is missing changes, autosaved or not
+    def has_unsaved(self):
+        return self.dirty or os.path.exists(self.old_name) or os.path.exists(self.autosave_name)
+
+    def is_compacting(self):
+        return not self.future is None and not self.future.done()
+
+    # the error of the last compaction, its changes stay journaled until the next one
+    def get_error(self):
+        if self.future is None or not self.future.done():
+            return None
+        return self.future.exception()
+
+    # writes a snapshot of the scores to the autosave in the background
+    def compact(self, df: pd.DataFrame):
+        if not self.dirty or self.is_compacting():
+            return
+        self.rotate()
+        self.dirty = False
+        self.future = self.executor.submit(self.write, df)
+
+    def rotate(self):
+        self.fp.close()
+
+        # a previous compaction failed, its changes are kept ahead of the new ones
+        if os.path.exists(self.old_name):
+            with open(self.journal_name) as fp, open(self.old_name, 'a') as old_fp:
+                old_fp.write(fp.read())
+            os.remove(self.journal_name)
+        else:
+            os.replace(self.journal_name, self.old_name)
+
+        self.fp = self.open_journal()
+
+    # a line cut off by a crash is ended, so the next change starts on its own line
+    def open_journal(self):
+        fp = open(self.journal_name, 'a+')
+        if fp.tell() != 0:
+            fp.seek(fp.tell() - 1)
+            if fp.read(1) != '\n':
+                fp.write('\n')
+        return fp
+
+    # the autosave is synced before it replaces the previous one, and the rotated
+    # journal is only deleted once it has
+    def write(self, df: pd.DataFrame):
+        tmp = self.autosave_name + '.tmp'
+        with profiler.span('write spreadsheet', file=self.autosave_name):
+            with open(tmp, 'w', newline='') as fp:
+                df.to_csv(fp, index=False)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.autosave_name)
+        os.remove(self.old_name)
+
+    # waits for a running compaction, then compacts the changes made since
+    def flush(self, df: pd.DataFrame):
+        if not self.future is None:
+            wait([self.future])
+        self.compact(df)
+
+    # the scores were saved to the spreadsheet, so the autosave and the journal are dropped
+    def reset(self):
+        if not self.future is None:
+            wait([self.future])
+        self.fp.truncate(0)
+        for name in [self.old_name, self.autosave_name]:
+            if os.path.exists(name):
+                os.remove(name)
+        self.dirty = False
+
+    # waits for a running compaction, the journal keeps anything not compacted
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.fp.close()
@@ -0,0 +1,46 @@
+
+import pandas as pd
+
+# ordinal scores of a spreadsheet, indexed by roi so that reading and writing the
+# scores of an roi doesn't scan the table. the DataFrame is only rebuilt when saving
+#  -df: the imported spreadsheet
+#  -key_column: column identifying the roi, e.g. SlideROI
+class ScoreStore:
+    def __init__(self, df: pd.DataFrame, key_column):
+        self.key_column = key_column
+        self.columns = list(df.columns)
+
+        # rows as dicts in spreadsheet order, and the position of each roi's first row
+        self.rows = df.to_dict('records')
+        self.positions = {}
+        for i, row in enumerate(self.rows):
+            self.positions.setdefault(row[self.key_column], i)
+
+    # score columns, every column except the key
+    def get_value_columns(self):
+        return [column for column in self.columns if column != self.key_column]
+
+    def get(self, key, column, default=0):
+        position = self.positions.get(key)
+        if position is None:
+            return default
+        return self.rows[position][column]
+
+    # sets some of the scores of an roi, a new roi is added with the other scores at 0.
+    # returns True if anything changed
+    def set(self, key, values: dict):
+        position = self.positions.get(key)
+        if position is None:
+            row = {column: 0 for column in self.columns}
+            row[self.key_column] = key
+            self.positions[key] = len(self.rows)
+            self.rows.append(row)
+        else:
+            row = self.rows[position]
+            if all(row.get(column) == value for column, value in values.items()):
+                return False
+        row.update(values)
+        return True
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=self.columns)
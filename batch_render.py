@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+from PyQt5.QtGui import QColor, QImage, QPainter
+from sana.image import Frame
+from sana.color_deconvolution import StainSeparator
+
+from DatasetIndex import DatasetIndex
+from Deconvolution import DeconvolutionEngine, MIN_OD_VAL, MAX_OD_VAL
+from ImageCanvas import draw_outlines
+from ImagePyramid import ImagePyramid
+from OverlayCompositor import OverlayLayer, blend_layers
+from OverlayDock import ROI_ENTRIES, get_roi_files, get_measurements, get_overlay_files, get_outline_path, load_overlay
+from MemoryBudget import get_default_budget
+from Rendering import DisplayTransform, render_region
+
+# renders every roi of a data directory without the gui, the same way the viewer does
+#  -data_directory/slide_name/roi_name/slide_name.png -> output_directory/slide_name_roi_name.png
+#  usage: python batch_render.py data_directory output_directory
+#             [-stain_A 0.0 2.0] [-disable_stain C]
+#             [-overlay AUTO_THRESH:red:0.5] [-overlay MAIN_ROI:black:15]
+#             [-rotation 30] [-scale 0.25] [-workers 8] [-max_memory 16]
+#
+# each worker renders one roi at a time in stripes, and is replaced after
+# -tasks_per_worker rois so memory can't build up over a long run. there are fewer
+# workers than -workers when the largest roi wouldn't fit -max_memory GB that many
+# times, by default half of the physical memory
+
+# the default stain ranges of the deconvolution dock
+STAIN_RANGE = (MIN_OD_VAL, MAX_OD_VAL)
+
+# rows blended and rendered at a time
+STRIPE_ROWS = 512
+
+# bytes per image pixel held at once by a worker, see estimate_nbytes
+BYTES_PER_PIXEL = 8
+
+# rendering options, shared by every roi
+#  -ranges: [(lo, hi) or None] for each of the 3 stains, None disables the stain
+#  -overlays: {label: (color, alpha or linewidth)}, labels as shown in the overlay dock
+#  -measurement: measurement of the mask overlays, by default the first one
+class RenderSettings:
+    def __init__(self, ranges, overlays, measurement="", rotation=0, scale=1.0):
+        self.ranges = ranges
+        self.overlays = overlays
+        self.measurement = measurement
+        self.rotation = rotation
+        self.scale = scale
+
+# separator and engine of the worker process, built once per process
+engine = None
+
+def init_worker():
+
+    # the process pool already uses every core
+    cv2.setNumThreads(1)
+
+    global engine
+    engine = DeconvolutionEngine(StainSeparator('H-DAB'), num_workers=1)
+
+def render_roi(file_name, settings: RenderSettings):
+    roi_directory = os.path.dirname(file_name)
+    image_array = Frame(file_name).img
+
+    # deconvolution, the image is unchanged when all stains are enabled
+    if any(stain_range is None for stain_range in settings.ranges):
+        image_array = engine.deconvolve_image(image_array, settings.ranges)
+
+    # masks, then rotation and scale, then outlines drawn at the output resolution
+    entries = [(filename, label, True) for filename, label, _ in get_roi_files(roi_directory)]
+    measurements = get_measurements(roi_directory)
+    measurement = settings.measurement
+    if measurement == "" and len(measurements) != 0:
+        measurement = measurements[0]
+    if measurement in measurements:
+        entries += [(filename, suffix, False) for filename, suffix in get_overlay_files(roi_directory, measurement)]
+
+    layers, outlines = [], []
+    for filename, label, outlines_only in entries:
+        if not label in settings.overlays:
+            continue
+        color, value = settings.overlays[label]
+        mask, bodies, holes = load_overlay(filename, outlines_only)
+        if outlines_only:
+            outlines.append((get_outline_path(bodies + holes), QColor(*color), value))
+        elif not mask.is_empty():
+            layers.append(OverlayLayer(mask, color=color, alpha=value))
+
+    # blended in place, the image isn't shared with anything
+    if len(layers) != 0 and not image_array.flags.writeable:
+        image_array = image_array.copy()
+    h, w = image_array.shape[:2]
+    for y in range(0, h, STRIPE_ROWS):
+        blend_layers(image_array, layers, 0, y, w, min(STRIPE_ROWS, h - y))
+
+    transform = DisplayTransform(image_array.shape, settings.rotation, settings.scale)
+    level_array, level_scale = ImagePyramid(image_array).get_level_for_scale(settings.scale)
+    w, h = transform.get_size()
+    out = np.empty((h, w, 3), dtype=np.uint8)
+    for y in range(0, h, STRIPE_ROWS):
+        out[y:y+STRIPE_ROWS] = render_stripe(level_array, level_scale, transform, outlines, y, w, min(STRIPE_ROWS, h - y))
+    return out
+
+# renders rows [y, y + h) of the output, outlines are painted by the same code as
+# the viewer's, offset like the viewer's tiles
+def render_stripe(level_array, level_scale, transform: DisplayTransform, outlines, y, w, h):
+    stripe = render_region(level_array, level_scale, transform, 0, y, w, h)
+    if len(outlines) == 0:
+        return stripe
+    image = QImage(stripe, w, h, stripe.strides[0], QImage.Format.Format_RGB888)
+    painter = QPainter(image)
+    draw_outlines(painter, transform, outlines, 0, y)
+    painter.end()
+    return get_image_array(image)
+
+# rough peak bytes of rendering an roi, from its size alone: the image, its deconvolved
+# copy, the pyramid levels under it and the masks, then the output. the stripes add little
+def estimate_nbytes(file_name, settings: RenderSettings):
+    with Image.open(file_name) as image:
+        w, h = image.size
+    out_w, out_h = DisplayTransform((h, w), settings.rotation, settings.scale).get_size()
+    return BYTES_PER_PIXEL * w * h + 3 * out_w * out_h
+
+# copies the pixels of an RGB888 QImage, painting on an image of an array copies it
+# instead of writing to the array. rows of the image are padded to 4 bytes
+def get_image_array(image: QImage):
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    rows = np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 3].reshape(image.height(), image.width(), 3).copy()
+
+# renders and writes one roi, errors are returned so one bad roi doesn't stop the batch
+def write_roi(entry, settings: RenderSettings, output_directory, skip_existing):
+    slide_name, roi_name, file_name = entry
+    output_file = os.path.join(output_directory, slide_name+'_'+roi_name+'.png')
+    if skip_existing and os.path.exists(output_file):
+        return output_file, None
+    try:
+        image_array = render_roi(file_name, settings)
+        if not cv2.imwrite(output_file, cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR, dst=image_array)):
+            raise OSError('could not write %s' % output_file)
+    except Exception as e:
+        return output_file, '%s: %s' % (type(e).__name__, e)
+    return output_file, None
+
+def get_color(name):
+    color = QColor(name)
+    if not color.isValid():
+        raise argparse.ArgumentTypeError('invalid color: %s' % name)
+    return (color.red(), color.green(), color.blue())
+
+# LABEL[:color[:value]], value is the alpha of masks and the linewidth of outlines
+def parse_overlay(arg):
+    fields = arg.split(':')
+    label = fields[0]
+    is_outline = label in [entry_label for _, entry_label, _ in ROI_ENTRIES]
+    if len(fields) > 1:
+        color = get_color(fields[1])
+    else:
+        color = get_color([color for _, entry_label, color in ROI_ENTRIES if entry_label == label][0] if is_outline else 'red')
+    if len(fields) > 2:
+        value = float(fields[2])
+    else:
+        value = 15 if is_outline else 1.0
+    return label, (color, value)
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_directory')
+    parser.add_argument('output_directory')
+    for stain in 'ABC':
+        parser.add_argument('-stain_'+stain, type=float, nargs=2, default=STAIN_RANGE, metavar=('LO', 'HI'))
+    parser.add_argument('-disable_stain', choices=list('ABC'), action='append', default=[])
+    parser.add_argument('-overlay', type=parse_overlay, action='append', default=[])
+    parser.add_argument('-measurement', default="")
+    parser.add_argument('-rotation', type=float, default=0)
+    parser.add_argument('-scale', type=float, default=1.0)
+    parser.add_argument('-workers', type=int, default=os.cpu_count())
+    parser.add_argument('-max_memory', type=float)
+    parser.add_argument('-tasks_per_worker', type=int, default=16)
+    parser.add_argument('-skip_existing', action='store_true')
+    args = parser.parse_args(argv)
+
+    ranges = []
+    for stain in 'ABC':
+        ranges.append(None if stain in args.disable_stain else tuple(getattr(args, 'stain_'+stain)))
+    settings = RenderSettings(ranges, dict(args.overlay), args.measurement, args.rotation, args.scale)
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    entries = DatasetIndex(args.data_directory).entries
+
+    max_memory = get_default_budget() if args.max_memory is None else int(args.max_memory * 1024**3)
+    workers = args.workers
+    if len(entries) != 0:
+        nbytes = max(estimate_nbytes(file_name, settings) for _, _, file_name in entries)
+        workers = max(1, min(workers, max_memory // nbytes))
+        if workers < args.workers:
+            print('using %d workers, about %.1fGB each' % (workers, nbytes / 1024**3))
+
+    kwargs = {}
+    if sys.version_info >= (3, 11):
+        kwargs['max_tasks_per_child'] = args.tasks_per_worker
+
+    t0 = time.perf_counter()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, **kwargs) as executor:
+        render = partial(write_roi, settings=settings, output_directory=args.output_directory,
+                         skip_existing=args.skip_existing)
+        for i, (output_file, error) in enumerate(executor.map(render, entries)):
+            if not error is None:
+                failed.append(output_file)
+                print('\n%s failed, %s' % (output_file, error))
+            print('\r%d/%d rois' % (i + 1, len(entries)), end='', flush=True)
+    print('\nrendered %d rois in %.1fs, %d failed' % (len(entries) - len(failed), time.perf_counter() - t0, len(failed)))
+    return 1 if len(failed) != 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sana.color_deconvolution import StainSeparator
+
+from Deconvolution import DeconvolutionEngine
+
+# compares StainSeparator separate/clip/combine against the DeconvolutionEngine
+# then how the engine scales with the number of worker threads
+#  usage: python benchmarks/bench_deconvolution.py [-size 2048] [-repeat 5] [-workers 1 2 4 8] [-chunk_rows 128]
+
+def get_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - t0)
+    return np.median(times), result
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-size', type=int, default=2048)
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('-chunk_rows', type=int, default=DeconvolutionEngine.CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    ss = StainSeparator('H-DAB')
+    t0 = time.perf_counter()
+    engine = DeconvolutionEngine(ss, num_workers=1, chunk_rows=args.chunk_rows)
+    print('engine built in %.3fs, valid=%s, max calibration error=%s' % \
+          (time.perf_counter() - t0, engine.valid, engine.max_error))
+
+    rng = np.random.default_rng(0)
+    image_array = rng.integers(0, 256, size=(args.size, args.size, 3), dtype=np.uint8)
+    ranges = [(0.1, 0.9), (0.0, 1.5), (0.2, 1.0)]
+    lo, hi = np.array([r[0] for r in ranges]), np.array([r[1] for r in ranges])
+
+    def reference_separate():
+        return ss.separate(image_array)
+    def reference_combine(stains):
+        return ss.combine(np.clip(stains, lo, hi))
+
+    t_ref_sep, ref_stains = get_time(reference_separate, args.repeat)
+    t_ref_comb, ref_image = get_time(lambda: reference_combine(ref_stains), args.repeat)
+    t_eng_sep, eng_stains = get_time(lambda: engine.separate(image_array), args.repeat)
+    t_eng_comb, eng_image = get_time(lambda: engine.deconvolve(eng_stains, ranges), args.repeat)
+
+    print('%dx%d pixels, median of %d' % (args.size, args.size, args.repeat))
+    print('  %-10s %12s %12s %8s' % ('', 'separator', 'engine', 'speedup'))
+    print('  %-10s %11.3fs %11.3fs %7.1fx' % ('separate', t_ref_sep, t_eng_sep, t_ref_sep / t_eng_sep))
+    print('  %-10s %11.3fs %11.3fs %7.1fx' % ('combine', t_ref_comb, t_eng_comb, t_ref_comb / t_eng_comb))
+    print('max separate difference: %g' % np.abs(eng_stains - ref_stains).max())
+    print('max combine difference: %d grey levels' % \
+          np.abs(eng_image.astype(np.int32) - np.asarray(ref_image).astype(np.int32)).max())
+
+    print('threads, %d rows per stripe (%d cpus)' % (args.chunk_rows, os.cpu_count()))
+    print('  %-8s %12s %12s %8s' % ('workers', 'separate', 'deconvolve', 'speedup'))
+    out = np.empty(image_array.shape, dtype=np.uint8)
+    for num_workers in args.workers:
+        engine = DeconvolutionEngine(ss, num_workers=num_workers, chunk_rows=args.chunk_rows)
+        t_sep, stains = get_time(lambda: engine.separate(image_array, out=eng_stains), args.repeat)
+        t_comb, _ = get_time(lambda: engine.deconvolve(stains, ranges, out=out), args.repeat)
+        if num_workers == args.workers[0]:
+            t_base = t_sep + t_comb
+        print('  %-8d %11.3fs %11.3fs %7.1fx' % (num_workers, t_sep, t_comb, t_base / (t_sep + t_comb)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,383 @@
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# the viewer is driven without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtCore import QEventLoop
+from PyQt5.QtWidgets import QApplication
+
+# times the render and navigation paths of the ImageViewer on generated datasets, and
+# writes latency percentiles and peak RSS to a json file so revisions can be compared
+#  usage: python benchmarks/bench_viewer.py [-sizes 2048 8192 16384] [-repeat 20] [-output bench_viewer.json]
+#         python benchmarks/bench_viewer.py -compare before.json after.json
+#
+# each size runs in its own process, so its peak RSS doesn't include the sizes before it.
+# an operation is timed until the display is repainted, not until it is scheduled
+#  -data_directory/size_N/SLIDE_X/ROI_N/SLIDE_X.png: the largest side of the image is N
+#  -data_directory/size_N/SLIDE_X/ROI_N/SLIDE_X_MAIN_ROI.npz: the roi outline
+#  -data_directory/size_N/SLIDE_X/ROI_N/AO/SLIDE_X_AUTO_THRESH.npz: the measurement mask
+
+# optical densities of hematoxylin and DAB, for generating stained looking images
+STAIN_VECTORS = np.array([
+    [0.650, 0.704, 0.286],
+    [0.268, 0.570, 0.776],
+], dtype=np.float32)
+
+# rows generated at a time, so 16k images never need full size float arrays
+CHUNK_ROWS = 1024
+
+# AO threshold on the DAB density
+AO_THRESHOLD = 0.6
+
+def get_dataset_directory(data_directory, size):
+    return os.path.join(data_directory, 'size_%d' % size)
+
+# (slide_name, roi_name) of the rois of a dataset, 2 rois per slide
+def get_roi_names(num_rois):
+    return [('SLIDE_%s' % chr(ord('A') + i // 2), 'ROI_%d' % (i % 2)) for i in range(num_rois)]
+
+def make_dataset(d, size, num_rois, seed=0):
+    rng = np.random.default_rng(seed)
+    h, w = size * 3 // 4, size
+    for slide_name, roi_name in get_roi_names(num_rois):
+        roi_directory = os.path.join(d, slide_name, roi_name)
+        os.makedirs(os.path.join(roi_directory, 'AO'), exist_ok=True)
+
+        # smooth stain densities upsampled from a coarse grid, so the structures
+        # have the same size in pixels at every image size
+        coarse = rng.random((max(2, h // 64), max(2, w // 64), 2), dtype=np.float32)
+        image_array = np.empty((h, w, 3), dtype=np.uint8)
+        ao_array = np.empty((h, w), dtype=np.uint8)
+        for y0 in range(0, h, CHUNK_ROWS):
+            y1 = min(h, y0 + CHUNK_ROWS)
+            densities = get_densities(coarse, h, w, y0, y1)
+            densities += rng.normal(0, 0.03, densities.shape).astype(np.float32)
+            od = densities @ STAIN_VECTORS
+            image_array[y0:y1] = np.clip(255 * np.exp(-od), 0, 255).astype(np.uint8)
+            ao_array[y0:y1] = densities[:, :, 1] > AO_THRESHOLD
+        cv2.imwrite(os.path.join(roi_directory, slide_name+'.png'), cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR))
+        np.savez_compressed(os.path.join(roi_directory, 'AO', slide_name+'_AUTO_THRESH.npz'), ao_array)
+        del image_array, ao_array
+
+        roi_array = np.zeros((h, w), dtype=np.uint8)
+        cv2.ellipse(roi_array, (w // 2, h // 2), (w * 2 // 5, h * 2 // 5), 0, 0, 360, 1, -1)
+        np.savez_compressed(os.path.join(roi_directory, slide_name+'_MAIN_ROI.npz'), roi_array)
+        del roi_array
+
+# densities of the rows [y0, y1) of the image, interpolated from the coarse grid
+def get_densities(coarse, h, w, y0, y1):
+    ch, cw = coarse.shape[:2]
+    map_x = np.broadcast_to(np.linspace(0, cw - 1, w, dtype=np.float32), (y1 - y0, w))
+    map_y = np.broadcast_to(np.linspace(0, ch - 1, h, dtype=np.float32)[y0:y1, None], (y1 - y0, w))
+    densities = cv2.remap(coarse, np.ascontiguousarray(map_x), np.ascontiguousarray(map_y), cv2.INTER_CUBIC)
+    return np.maximum(densities * 1.2, 0)
+
+def get_peak_rss():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+# latencies of each operation, in the order they were run
+class Timings:
+    def __init__(self):
+        self.times = {}
+        self.peak_rss = {}
+
+    def measure(self, name, f):
+        t0 = time.perf_counter()
+        f()
+        self.times.setdefault(name, []).append(time.perf_counter() - t0)
+        self.peak_rss[name] = get_peak_rss()
+
+    # latency percentiles in ms, and the peak RSS of the process once the operation was done
+    def get_results(self):
+        results = {}
+        for name, times in self.times.items():
+            times = 1000 * np.array(times)
+            results[name] = {
+                'n': len(times),
+                'mean_ms': float(times.mean()),
+                'p50_ms': float(np.percentile(times, 50)),
+                'p90_ms': float(np.percentile(times, 90)),
+                'p99_ms': float(np.percentile(times, 99)),
+                'max_ms': float(times.max()),
+                'peak_rss_bytes': self.peak_rss[name],
+            }
+        return results
+
+# drives an ImageViewer through each operation, waiting for it to be displayed
+class ViewerBenchmark:
+    def __init__(self, app: QApplication, viewer, d, repeat):
+        self.app = app
+        self.viewer = viewer
+        self.d = d
+        self.repeat = repeat
+        self.timings = Timings()
+
+        self.file_names = []
+        for slide_name in sorted(os.listdir(d)):
+            for roi_name in sorted(os.listdir(os.path.join(d, slide_name))):
+                self.file_names.append(os.path.join(d, slide_name, roi_name, slide_name+'.png'))
+
+    # renders anything still scheduled, then paints the visible tiles and outlines
+    def draw(self):
+        self.viewer.render_scheduler.flush()
+        self.viewer.canvas.viewport().repaint()
+
+    def wait_for_frame(self):
+        while self.viewer.frame_loader.is_loading():
+            self.app.processEvents(QEventLoop.ProcessEventsFlag.WaitForMoreEvents)
+        self.draw()
+
+    # lets the neighbouring rois finish loading, as they would while the roi is looked at
+    def wait_for_prefetch(self):
+        while not all(future.done() for future in list(self.viewer.frame_cache.futures.values())):
+            self.app.processEvents()
+            time.sleep(0.005)
+        self.app.processEvents()
+
+    def open_frame(self, file_name):
+        self.viewer.open_frame(file_name)
+        self.wait_for_frame()
+
+    # deletes the mask sidecars and contour caches of the dataset's .npz files, the
+    # dataset directory is reused across runs so they would otherwise make every open warm
+    def clear_disk_caches(self):
+        from ContourCache import get_cache_filename
+        from OverlayDock import get_sidecar_filename
+
+        for root, _, files in os.walk(self.d):
+            for f in files:
+                if not f.endswith('.npz'):
+                    continue
+                for cache_file in [get_sidecar_filename(os.path.join(root, f)), get_cache_filename(os.path.join(root, f))]:
+                    if os.path.exists(cache_file):
+                        os.remove(cache_file)
+
+    # opening an roi which is in none of the viewer's caches, and then which only has
+    # the sidecars and contour caches written by the first open
+    def bench_open_frame(self):
+        for i in range(self.repeat):
+            file_name = self.file_names[i % len(self.file_names)]
+            self.wait_for_prefetch()
+            self.clear_disk_caches()
+            self.viewer.frame_cache.clear()
+            self.viewer.pyramid_cache.clear()
+            self.timings.measure('open_frame', lambda: self.open_frame(file_name))
+
+            self.wait_for_prefetch()
+            self.viewer.frame_cache.clear()
+            self.viewer.pyramid_cache.clear()
+            self.timings.measure('open_frame_disk_cached', lambda: self.open_frame(file_name))
+
+    # stepping through the dataset, with time for the prefetch between steps
+    def bench_open_next_frame(self):
+        self.open_frame(self.file_names[0])
+        for i in range(self.repeat):
+            self.wait_for_prefetch()
+            if self.viewer.file_name == self.file_names[-1]:
+                self.open_frame(self.file_names[0])
+                self.wait_for_prefetch()
+            self.timings.measure('open_next_frame', lambda: (self.viewer.open_next_frame(), self.wait_for_frame()))
+
+    # slider ticks show the preview, settling replaces it with the full resolution image
+    def bench_deconvolution(self):
+        widget = self.viewer.deconvolution_dock.widget
+        widget.stain_A_checkbox.setChecked(False)
+        self.draw()
+        for i in range(self.repeat):
+            for j in range(3):
+                value = (i * 3 + j) % 40
+                self.timings.measure('deconvolution_slider', lambda: (widget.stain_B_slider.setValue((value, 60 + value)), self.draw()))
+            self.viewer.preview_timer.stop()
+            self.timings.measure('deconvolution_settle', lambda: (self.viewer.stop_preview(), self.draw()))
+        widget.stain_B_slider.setValue((widget.MIN_SLIDER_VAL, widget.MAX_SLIDER_VAL))
+        widget.stain_A_checkbox.setChecked(True)
+        self.viewer.preview_timer.stop()
+        self.viewer.stop_preview()
+        self.draw()
+
+    def bench_overlays(self):
+        for widget in self.viewer.overlay_dock.widget.entry_widgets:
+            name = 'outline_toggle' if widget.outlines_only else 'overlay_toggle'
+            for i in range(self.repeat):
+                self.timings.measure(name, lambda: (widget.checkbox.setChecked(not widget.checkbox.isChecked()), self.draw()))
+            widget.checkbox.setChecked(False)
+            self.draw()
+
+    def bench_rotation(self):
+        dial = self.viewer.rotation_dial
+        for i in range(self.repeat):
+            self.timings.measure('rotation_tick', lambda: (dial.setValue(dial.value() + 1), self.draw()))
+        self.viewer.set_default_image_rotation()
+        self.draw()
+
+    def bench_zoom(self):
+        for i in range(self.repeat):
+            zoom = self.viewer.zoom_in if i % 2 == 0 else self.viewer.zoom_out
+            self.timings.measure('zoom_step', lambda: (zoom(), self.draw()))
+        self.viewer.reset_zoom()
+        self.draw()
+
+    def bench_save_frame(self, tmp_directory):
+        file_name = os.path.join(tmp_directory, 'frame.png')
+        for i in range(self.repeat):
+            self.timings.measure('save_frame', lambda: self.viewer.save_frame(file_name))
+
+    # scores are set with the spinboxes, which journals them
+    def bench_spreadsheet(self, tmp_directory):
+        file_name = os.path.join(tmp_directory, 'scores.csv')
+        with open(file_name, 'w') as fp:
+            fp.write('SlideROI,Score_A,Score_B\n')
+            for f in self.file_names:
+                roi_directory = os.path.dirname(f)
+                fp.write('%s_%s,0,0\n' % (os.path.basename(os.path.dirname(roi_directory)), os.path.basename(roi_directory)))
+        self.viewer.import_spreadsheet(file_name)
+        for i in range(self.repeat):
+            spinbox = self.viewer.ordinal_spinboxs[i % len(self.viewer.ordinal_spinboxs)]
+            self.timings.measure('spreadsheet_update', lambda: spinbox.set_value((spinbox.get_value() + 1) % 11))
+        self.viewer.close_score_journal()
+
+    def run(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            self.bench_open_frame()
+            self.bench_open_next_frame()
+            self.open_frame(self.file_names[0])
+            self.wait_for_prefetch()
+            self.bench_deconvolution()
+            self.bench_overlays()
+            self.bench_rotation()
+            self.bench_zoom()
+            self.bench_save_frame(tmp_directory)
+            self.bench_spreadsheet(tmp_directory)
+        finally:
+            shutil.rmtree(tmp_directory)
+        return self.timings.get_results()
+
+# runs the benchmark of one dataset in this process
+def run_dataset(d, repeat, result_file):
+    app = QApplication(sys.argv[:1])
+
+    from ImageViewer import ImageViewer
+    viewer = ImageViewer()
+    viewer.resize(1280, 800)
+    viewer.show()
+    app.processEvents()
+
+    results = ViewerBenchmark(app, viewer, d, repeat).run()
+    with open(result_file, 'w') as fp:
+        json.dump({'ops': results, 'peak_rss_bytes': get_peak_rss()}, fp)
+
+def get_revision():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return revision, len(status) != 0
+
+def print_results(size, result):
+    print('%dpx, peak RSS %.0f MB' % (size, result['peak_rss_bytes'] / 1024**2))
+    print('  %-22s %6s %10s %10s %10s %10s' % ('', 'n', 'p50', 'p90', 'p99', 'max'))
+    for name, op in result['ops'].items():
+        print('  %-22s %6d %9.1fms %9.1fms %9.1fms %9.1fms' % \
+              (name, op['n'], op['p50_ms'], op['p90_ms'], op['p99_ms'], op['max_ms']))
+
+# prints the change of each operation between two result files
+def compare(before_file, after_file):
+    with open(before_file) as fp:
+        before = json.load(fp)
+    with open(after_file) as fp:
+        after = json.load(fp)
+    print('%s -> %s' % (before.get('revision'), after.get('revision')))
+    for size, after_result in after['sizes'].items():
+        if not size in before['sizes']:
+            continue
+        before_result = before['sizes'][size]
+        print('%spx, peak RSS %.0f -> %.0f MB' % \
+              (size, before_result['peak_rss_bytes'] / 1024**2, after_result['peak_rss_bytes'] / 1024**2))
+        print('  %-22s %21s %8s %21s %8s' % ('', 'p50', '', 'p90', ''))
+        for name, op in after_result['ops'].items():
+            if not name in before_result['ops']:
+                continue
+            line = '  %-22s' % name
+            for key in ['p50_ms', 'p90_ms']:
+                t0, t1 = before_result['ops'][name][key], op[key]
+                line += ' %8.1fms -> %8.1fms %+7.0f%%' % (t0, t1, 100 * (t1 - t0) / t0 if t0 > 0 else 0)
+            print(line)
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sizes', type=int, nargs='+', default=[2048, 8192, 16384])
+    parser.add_argument('-repeat', type=int, default=20)
+    parser.add_argument('-rois', type=int, default=3)
+    parser.add_argument('-data_directory', default=os.path.join(tempfile.gettempdir(), 'bench_viewer'))
+    parser.add_argument('-output', default='bench_viewer.json')
+    parser.add_argument('-compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('-run', help=argparse.SUPPRESS)
+    parser.add_argument('-result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if not args.compare is None:
+        compare(*args.compare)
+        return
+    if not args.run is None:
+        run_dataset(args.run, args.repeat, args.result)
+        return
+
+    revision, dirty = get_revision()
+    output = {
+        'revision': revision,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'sizes': {},
+    }
+    for size in args.sizes:
+
+        # datasets are generated once and reused by later runs
+        d = get_dataset_directory(args.data_directory, size)
+        if not os.path.exists(d):
+            print('generating %dpx dataset in %s' % (size, d))
+            make_dataset(d + '.tmp', size, args.rois)
+            os.replace(d + '.tmp', d)
+
+        fd, result_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '-run', d, '-repeat', str(args.repeat),
+                            '-result', result_file], check=True)
+            with open(result_file) as fp:
+                result = json.load(fp)
+        finally:
+            os.remove(result_file)
+        output['sizes'][str(size)] = result
+        print_results(size, result)
+
+    with open(args.output, 'w') as fp:
+        json.dump(output, fp, indent=2)
+    print('results written to %s' % args.output)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,19 +1,41 @@
 
 import os
 import sys
+import argparse
 
 from PyQt5.QtWidgets import QApplication
 from ImageViewer import ImageViewer
+from Profiler import profiler
+import OverlayDock
 
+#  usage: python main.py [file_name] [-trace trace.json] [-memory_budget 8] [-sidecars]
+#  -trace: records a Chrome trace of the whole session, written on exit
+#  -memory_budget: GB of image buffers and caches, by default half of the physical memory
+#  -sidecars: keeps decompressed measurement masks in a user cache directory, see OverlayDock
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    if len(sys.argv) > 1:
-        f = sys.argv[1]
-    else:
-        f = None
-    viewer = ImageViewer(f)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file_name', nargs='?')
+    parser.add_argument('-trace')
+    parser.add_argument('-memory_budget', type=float)
+    parser.add_argument('-sidecars', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+
+    OverlayDock.USE_SIDECARS = args.sidecars
+
+    if not args.trace is None:
+        profiler.start_trace()
+    memory_budget = None
+    if not args.memory_budget is None:
+        memory_budget = int(args.memory_budget * 1024**3)
+    viewer = ImageViewer(args.file_name, memory_budget)
     viewer.show()
-    sys.exit(app.exec())
+    ret = app.exec()
+
+    # stopping the trace from the menu already wrote it
+    if not args.trace is None and profiler.tracing:
+        profiler.write_trace(args.trace)
+    sys.exit(ret)
 
     # TODO QScrollArea support mouse
     # base on https://github.com/baoboa/pyqt5/blob/master/examples/widgets/imageviewer.py
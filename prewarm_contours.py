@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from DatasetIndex import DatasetIndex
+from OverlayDock import get_roi_files, load_contours
+
+# traces and caches the roi outline contours of a whole dataset ahead of time,
+# so opening an roi in the viewer never has to trace them, see ContourCache
+#  usage: python prewarm_contours.py data_directory [-workers 8]
+
+# returns (number of contours, error), errors are returned so one bad mask doesn't stop the run
+def warm(filename):
+    try:
+        bodies, holes = load_contours(filename)
+    except Exception as e:
+        return 0, '%s: %s' % (type(e).__name__, e)
+    return len(bodies) + len(holes), None
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_directory')
+    parser.add_argument('-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    dataset_index = DatasetIndex(args.data_directory)
+    filenames = []
+    for _, _, file_name in dataset_index.entries:
+        roi_directory = os.path.dirname(file_name)
+        if os.path.isdir(roi_directory):
+            filenames += [filename for filename, _, _ in get_roi_files(roi_directory)]
+
+    t0 = time.perf_counter()
+    num_contours = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for i, (filename, (n, error)) in enumerate(zip(filenames, executor.map(warm, filenames, chunksize=4))):
+            num_contours += n
+            if not error is None:
+                failed.append(filename)
+                print('\n%s failed, %s' % (filename, error))
+            print('\r%d/%d outlines' % (i + 1, len(filenames)), end='', flush=True)
+    print('\ncached %d contours from %d outlines in %.1fs, %d failed' % \
+          (num_contours, len(filenames) - len(failed), time.perf_counter() - t0, len(failed)))
+    return 1 if len(failed) != 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))